@@ -9,9 +9,13 @@ from celery import Celery
 
 
 class ColanderPipeline:
+    """Sends scraped items to the tasks.ops.products.import_products task, in batches of batch_size items. Whatever is
+    left over is sent when the spider closes."""
+    batch_size = 500
 
     def __init__(self):
         self.celery = None
+        self.items = []
 
     def open_spider(self, spider):
         self.celery = Celery(
@@ -21,16 +25,26 @@ class ColanderPipeline:
         )
 
     def close_spider(self, spider):
+        self.flush()
         self.celery = None
 
     def process_item(self, item, spider):
         item_data = {k: v for k, v in dict(item).items() if v is not None}
 
-        self.celery.send_task(
-            'tasks.ops.products.clean_and_import',
-            kwargs={'data': item_data}
-        )
+        self.items.append(item_data)
+        if len(self.items) >= self.batch_size:
+            self.flush()
 
         return item
 
+    def flush(self):
+        """Send the buffered items to be imported."""
+        if not self.items:
+            return
 
+        self.celery.send_task(
+            'tasks.ops.products.import_products',
+            kwargs={'items': self.items},
+            queue='spiders'
+        )
+        self.items = []
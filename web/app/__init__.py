@@ -13,6 +13,19 @@ from flask_moment import Moment
 ########################################################################################################################
 
 
+class Throttled(Exception):
+    """Raised when an API call would have to wait for its quota to be restored. Instead of blocking the worker, the
+    task running in the worker is retried after :countdown: seconds. Only raised when that task is a single API call
+    (see ContextTask.throttle_units), so nothing else gets repeated."""
+
+    def __init__(self, countdown, message=None):
+        super().__init__(message or f'Throttled, try again in {countdown:.1f} seconds')
+        self.countdown = countdown
+
+
+########################################################################################################################
+
+
 class FlaskCelery(celery.Celery):
 
     def __init__(self, app=None, *args, **kwargs):
@@ -22,13 +35,25 @@ class FlaskCelery(celery.Celery):
         _celery = self
 
         class ContextTask(TaskBase):
+            # Tasks that are retried when they are Throttled. Each one makes a single API call, so it can be repeated
+            # from the top. Throttle retries count against the task's own retries, with a higher limit.
+            throttle_units = ('tasks.mws.', 'tasks.parsed.')
+            throttle_max_retries = 100
 
             def __call__(self, *args, **kwargs):
-                if has_app_context():
-                    return TaskBase.__call__(self, *args, **kwargs)
-                else:
-                    with _celery.app.app_context():
+                called_directly = self.request.called_directly
+
+                try:
+                    if has_app_context():
                         return TaskBase.__call__(self, *args, **kwargs)
+                    else:
+                        with _celery.app.app_context():
+                            return TaskBase.__call__(self, *args, **kwargs)
+                except Throttled as e:
+                    # Let the task that is running in the worker reschedule itself
+                    if called_directly or not self.name.startswith(self.throttle_units):
+                        raise
+                    raise self.retry(exc=e, countdown=e.countdown, max_retries=self.throttle_max_retries)
 
             def get_priority(self):
                 try:
@@ -72,18 +97,28 @@ class FlaskCelery(celery.Celery):
                 },
                 'tasks.ops.products.clean_and_import': {
                     'queue': 'spiders'
+                },
+                'tasks.ops.products.import_products': {
+                    'queue': 'spiders'
                 }
             }
         ]
 
-    @staticmethod
-    def priority_router(name, args, kwargs, options, task=None, **kw):
+    def priority_router(self, name, args, kwargs, options, task=None, **kw):
+        """Route tasks to the queue for their priority. With IO_WORKER_QUEUES set, the network-bound tasks.mws.* and
+        tasks.parsed.* tasks go to the io, io_medium and io_high queues instead, which are served by a gevent worker
+        (see supervisord_worker_gevent.conf). Everything else stays on the prefork workers, including the MWS calls that
+        ops tasks make directly, since those never go through the router."""
         priority = options.get('priority') or 0
+        io = self.app.config.get('IO_WORKER_QUEUES') and name.startswith(('tasks.mws.', 'tasks.parsed.'))
+        prefix = 'io_' if io else ''
 
         if priority == 1:
-            return {'queue': 'medium'}
+            return {'queue': prefix + 'medium'}
         elif priority > 1:
-            return {'queue': 'high'}
+            return {'queue': prefix + 'high'}
+        elif io:
+            return {'queue': 'io'}
 
 
 ########################################################################################################################
@@ -505,25 +505,16 @@ class Product(db.Model, UpdateMixin):
         q = cls.query
 
         if arg == 'inventory':
-            inv_skus = db.select([
-                FBAManageInventoryReportLine.asin
-            ]).where(
-                FBAManageInventoryReportLine.report_id == db.select([
-                    AmzReport.id
-                ]).where(
-                    db.and_(
-                        AmzReport.type == FBAManageInventoryReportLine.report_type,
-                        AmzReport.status == '_DONE_',
-                    )
-                ).order_by(
-                    AmzReport.start_date.desc()
-                ).limit(1)
-            )
+            report = AmzReport.latest(FBAManageInventoryReportLine.report_type)
+            q = q.filter(Product.vendor_id == Vendor.get_amazon().id)
 
-            q = q.filter(
-                Product.vendor_id == Vendor.get_amazon().id,
-                Product.sku.in_(inv_skus)
-            )
+            if report is not None:
+                inv_skus = FBAManageInventoryReportLine.snapshot_query(report).with_entities(
+                    FBAManageInventoryReportLine.asin
+                )
+                q = q.filter(Product.sku.in_(inv_skus))
+            else:
+                q = q.filter(db.false())
         elif arg is not None:
             raise ValueError(f'Unsupported argument: {arg}')
 
@@ -1245,13 +1236,178 @@ CONDITIONS = (
 ########################################################################################################################
 
 
+def report_value_converter(column_type):
+    """Return a function that converts a report value (a string) to a Python value for :column_type:. Empty values
+    are converted to None."""
+    def nullable(convert):
+        return lambda value: convert(value) if value else None
+
+    if isinstance(column_type, db.Boolean):
+        values = {'yes': True, 'y': True, 'true': True, '1': True, 'no': False, 'n': False, 'false': False, '0': False}
+        return lambda value: values.get(value.lower(), bool(value)) if value else None
+    elif isinstance(column_type, db.Enum):
+        return lambda value: value if value in column_type.enums else None
+    elif isinstance(column_type, db.Integer):
+        return nullable(int)
+    elif isinstance(column_type, db.Float):
+        return nullable(float)
+    elif isinstance(column_type, db.Numeric):
+        return nullable(decimal.Decimal)
+    elif isinstance(column_type, db.DateTime):
+        return nullable(lambda value: datetime.strptime(value[:19].replace(' ', 'T'), '%Y-%m-%dT%H:%M:%S'))
+    else:
+        return lambda value: value
+
+
+def report_values_equal(a, b):
+    """Return True if two report values are the same. Floats are compared approximately, since MySQL stores them in
+    single precision."""
+    if isinstance(a, float) and isinstance(b, float):
+        return abs(a - b) <= 1e-6 * max(abs(a), abs(b))
+
+    return a == b
+
+
 class AmzReportLineMixin:
     report_type = NotImplementedError
 
+    # The columns that identify a line from one report to the next. If set, reports are stored as the lines that
+    # changed since the previous report, with removed lines marked by the 'removed' column. Use snapshot() or
+    # history() to rebuild a report's full contents.
+    diff_key = None
+
+    # Store a full report after this many differences, so rebuilding a report never has to read a longer chain
+    diff_limit = 48
+
+    # Existing line tables need this column (and amz_report needs diff_base_id) added by hand; migrations/ has no
+    # revision history to add them to.
+    removed = db.Column(db.Boolean, default=False)
+
+    # Line classes by report type, filled in as they are defined
+    _report_types = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        AmzReportLineMixin._report_types[cls.report_type] = cls
+
     @classmethod
     def field_names(cls):
         return db.inspect(cls).columns.keys()
 
+    @classmethod
+    def converters(cls):
+        """Return a dictionary of functions that convert report values to each column's type, keyed by column name.
+        Built once per class, from the column types."""
+        if '_converters' not in cls.__dict__:
+            cls._converters = {
+                column.key: report_value_converter(column.type) for column in db.inspect(cls).columns
+            }
+
+        return cls._converters
+
+    @staticmethod
+    def for_report_type(report_type):
+        """Return the line class for :report_type:."""
+        try:
+            return AmzReportLineMixin._report_types[report_type]
+        except KeyError:
+            raise ValueError(f'Unsupported report type: {report_type}')
+
+    @classmethod
+    def line_key(cls, line):
+        """Return the diff key of :line:, which is either a line object or a dictionary of its values."""
+        if isinstance(line, collections.Mapping):
+            return tuple(line.get(c) for c in cls.diff_key)
+
+        return tuple(getattr(line, c) for c in cls.diff_key)
+
+    @classmethod
+    def diff(cls, rows, previous):
+        """Yield the rows (dictionaries of column values) in :rows: that are new or changed compared to :previous:, a
+        dictionary of the previous report's rows keyed by line_key(). Rows in :previous: that are not in :rows: are
+        yielded last, marked as removed."""
+        compared = [c for c in cls.field_names() if c not in ('id', 'report_id', 'removed')]
+        previous = dict(previous)
+
+        for row in rows:
+            old = previous.pop(cls.line_key(row), None)
+            if old is None or not all(report_values_equal(row.get(c), old.get(c)) for c in compared):
+                yield row
+
+        for old in previous.values():
+            yield {**old, 'removed': True}
+
+    @classmethod
+    def history(cls, reports, *criteria):
+        """Yield (report, lines) for each of :reports:, where lines is the report's full list of lines matching
+        :criteria:, rebuilt from the stored differences. Each report is rebuilt by following its own diff_base_id links
+        (see AmzReport.chain()), so :reports: don't have to be consecutive; reports that continue the chain of the one
+        before them are rebuilt incrementally. Each line is the object stored by the report where it last changed."""
+        reports = list(reports)
+        if not reports:
+            return
+
+        bases = AmzReport.diff_bases(cls.report_type)
+        chains = {r.id: r.chain(bases) for r in reports}
+
+        stored = collections.defaultdict(list)
+        report_ids = {i for chain in chains.values() for i in chain}
+        for line in cls.query.filter(cls.report_id.in_(report_ids), *criteria).order_by(cls.id):
+            stored[line.report_id].append(line)
+
+        state, state_id = collections.OrderedDict(), None
+        for report in reports:
+            chain = chains[report.id]
+            if state_id in chain:
+                chain = chain[chain.index(state_id) + 1:]
+            else:
+                state.clear()
+
+            for report_id in chain:
+                cls._apply_lines(state, stored[report_id])
+
+            state_id = report.id
+            yield report, list(state.values())
+
+    @classmethod
+    def snapshot(cls, report, *criteria):
+        """Return the full list of lines in :report: that match :criteria:, rebuilt from the stored differences."""
+        if cls.diff_key is None:
+            return report.lines.filter(*criteria).all()
+
+        return next(cls.history([report], *criteria))[1]
+
+    @classmethod
+    def snapshot_query(cls, report):
+        """Return a query for the lines in the full contents of :report:, for use in SQL instead of loading the
+        snapshot. Lines are stored in the order of the chain, so each key's last stored line is its current one."""
+        if cls.diff_key is None:
+            return report.lines
+
+        chain = report.chain()
+        current = db.session.query(
+            db.func.max(cls.id)
+        ).filter(
+            cls.report_id.in_(chain)
+        ).group_by(
+            *(getattr(cls, c) for c in cls.diff_key)
+        )
+
+        return cls.query.filter(
+            cls.id.in_(current),
+            db.or_(cls.removed.is_(False), cls.removed.is_(None))
+        )
+
+    @classmethod
+    def _apply_lines(cls, state, lines):
+        """Apply the lines stored for a report to :state:, a dictionary of lines keyed by line_key()."""
+        for line in lines:
+            key = cls.line_key(line)
+            if line.removed:
+                state.pop(key, None)
+            else:
+                state[key] = line
+
     def iter_fields(self):
         names = self.field_names()
         values = map(lambda k: getattr(self, k), names)
@@ -1270,16 +1426,48 @@ class AmzReport(db.Model, UpdateMixin):
     report_id = db.Column(db.String(64))
     complete = db.Column(db.Boolean, default=False)
 
+    # If set, the lines stored for this report are only the ones that changed since this report. Every other line is
+    # unchanged since diff_base.
+    diff_base_id = db.Column(db.Integer, db.ForeignKey('amz_report.id'))
+    diff_base = db.relationship('AmzReport', remote_side=[id])
+
     @property
     def lines(self):
+        """The lines stored for this report. For reports stored as differences, use the line class's snapshot()."""
         if self.type is None:
             return None
-        try:
-            line_type = [t for t in AmzReportLineMixin.__subclasses__() if t.report_type == self.type][0]
-        except IndexError:
-            raise ValueError(f'Unsupported report type: {self.type}')
 
-        return line_type.query.filter_by(report_id=self.id)
+        return AmzReportLineMixin.for_report_type(self.type).query.filter_by(report_id=self.id)
+
+    @classmethod
+    def latest(cls, report_type):
+        """Return the most recent downloaded report of :report_type:, or None."""
+        return cls.query.filter(
+            cls.type == report_type,
+            cls.status == '_DONE_',
+            cls.complete.is_(True)
+        ).order_by(
+            cls.start_date.desc()
+        ).first()
+
+    @classmethod
+    def diff_bases(cls, report_type):
+        """Return a dictionary of each :report_type: report's diff_base_id, keyed by report id."""
+        return dict(
+            db.session.query(cls.id, cls.diff_base_id).filter(cls.type == report_type).all()
+        )
+
+    def chain(self, bases=None):
+        """Return the ids of the reports needed to rebuild this one: the last full report, each difference after it,
+        and this report. :bases: is the result of diff_bases(), if it has already been loaded."""
+        if bases is None:
+            bases = self.diff_bases(self.type)
+
+        chain = [self.id]
+        while bases.get(chain[-1]) is not None:
+            chain.append(bases[chain[-1]])
+
+        return chain[::-1]
 
 
 ########################################################################################################################
@@ -1288,6 +1476,7 @@ class AmzReport(db.Model, UpdateMixin):
 class FBAManageInventoryReportLine(db.Model, UpdateMixin, AmzReportLineMixin):
     """A single line on the FBA Manage Inventory report."""
     report_type = '_GET_FBA_MYI_UNSUPPRESSED_INVENTORY_DATA_'
+    diff_key = ('sku',)
 
     id = db.Column(db.Integer, primary_key=True)
     report_id = db.Column(db.Integer, db.ForeignKey('amz_report.id', ondelete='CASCADE'), nullable=False)
@@ -113,6 +113,21 @@ def redis_info(section):
     )
 
 
+@app.route('/api/redis/quota')
+def redis_quota():
+    """Return the throttle state of each MWS operation, as kept in its usage hash."""
+    r = redis.from_url(app.config['BROKER_URL'])
+    quotas = {}
+
+    for key in r.scan_iter(match='tasks.mws.*_usage'):
+        usage = r.hgetall(key)
+        quotas[key.decode()[:-len('_usage')]] = {
+            field.decode(): float(value) for field, value in usage.items()
+        }
+
+    return jsonify(quotas)
+
+
 @app.route('/api/<obj_type>/<int:obj_id>', methods=['POST'])
 @app.route('/api/<obj_type>/<int:obj_id>/<attr>', methods=['GET'])
 @login_required
@@ -532,23 +547,34 @@ def inventory(product_id):
     else:
         raise ValueError(f'Invalid value for frame: {frame}')
 
-    history = db.session.query(
-        AmzReport.end_date,
-        FBAManageInventoryReportLine.afn_fulfillable_quantity,
-        FBAManageInventoryReportLine.afn_reserved_quantity,
-        FBAManageInventoryReportLine.afn_unsellable_quantity,
-        FBAManageInventoryReportLine.afn_inbound_shipped_quantity,
-        FBAManageInventoryReportLine.afn_inbound_receiving_quantity,
-        FBAManageInventoryReportLine.afn_inbound_working_quantity,
-        FBAManageInventoryReportLine.your_price
-    ).filter(
-        FBAManageInventoryReportLine.asin == product.sku,
-        AmzReport.id == FBAManageInventoryReportLine.report_id,
+    # Inventory reports are stored as differences, so rebuild each report's lines for this product
+    reports = AmzReport.query.filter(
+        AmzReport.type == FBAManageInventoryReportLine.report_type,
+        AmzReport.status == '_DONE_',
+        AmzReport.complete.is_(True),
         AmzReport.end_date >= start
     ).order_by(
         AmzReport.end_date.asc()
     ).all()
 
+    history = [
+        (
+            report.end_date,
+            line.afn_fulfillable_quantity,
+            line.afn_reserved_quantity,
+            line.afn_unsellable_quantity,
+            line.afn_inbound_shipped_quantity,
+            line.afn_inbound_receiving_quantity,
+            line.afn_inbound_working_quantity,
+            line.your_price
+        )
+        for report, lines in FBAManageInventoryReportLine.history(
+            reports,
+            FBAManageInventoryReportLine.asin == product.sku
+        )
+        for line in lines
+    ]
+
     return jsonify({
         'labels': [h[0] for h in history],
         'fulfillable': [h[1] for h in history],
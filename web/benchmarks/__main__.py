@@ -0,0 +1,215 @@
+"""Benchmark the response parsers in tasks.parsed, without Celery or network access.
+
+Run from the web directory:
+
+    python -m benchmarks                    # run every case, and compare with baseline.json
+    python -m benchmarks ItemLookup         # run only the named cases
+    python -m benchmarks --save             # run, and store the results as the new baseline
+
+Exits with a non-zero status if any case's p50 latency or peak memory is worse than the baseline by more than the
+tolerance, or if there is no baseline to compare with. Baselines depend on the machine, so save one on the box the
+comparisons will be made on.
+
+Peak memory is measured by parsing each case once more in a fresh interpreter, as the growth in the process's maximum
+resident set size. Unlike tracemalloc, that includes lxml's own allocations.
+"""
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+from collections import namedtuple
+
+from benchmarks import fixtures
+from tasks.parsed.common import AmzXmlResponse
+from tasks.parsed.products import parse_matching_products, parse_competitive_pricing
+from tasks.parsed.product_adv import parse_item_lookup
+from tasks.parsed.inventory import parse_inventory_supply
+from tasks.parsed.reports import parse_report_request_list, parse_report
+
+
+########################################################################################################################
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Memory regressions smaller than this (in bytes) are ignored, since the resident set size moves in whole pages and
+# allocator arenas
+MEMORY_SLACK = 1024 * 1024
+
+# A benchmark case: a function that returns the response body, and a function that parses it and returns the number
+# of items parsed.
+Case = namedtuple('Case', ['load', 'parse'])
+
+CASES = {
+    'ListMatchingProducts': Case(
+        lambda: fixtures.load('ListMatchingProducts', fixtures.list_matching_products, count=10),
+        lambda body: len(parse_matching_products(AmzXmlResponse(body, stream=True)))
+    ),
+    'ListMatchingProducts_large': Case(
+        lambda: fixtures.load('ListMatchingProducts_large', fixtures.list_matching_products, count=2000),
+        lambda body: len(parse_matching_products(AmzXmlResponse(body, stream=True)))
+    ),
+    'GetCompetitivePricingForASIN': Case(
+        lambda: fixtures.load('GetCompetitivePricingForASIN', fixtures.competitive_pricing, count=20),
+        lambda body: sum(len(d) for d in parse_competitive_pricing(AmzXmlResponse(body)))
+    ),
+    'ItemLookup': Case(
+        lambda: fixtures.load('ItemLookup', fixtures.item_lookup, count=10),
+        lambda body: sum(len(d) for d in parse_item_lookup(AmzXmlResponse(body), ''))
+    ),
+    'ListInventorySupply': Case(
+        lambda: fixtures.load('ListInventorySupply', fixtures.inventory_supply, count=50),
+        lambda body: len(parse_inventory_supply(AmzXmlResponse(body, stream=True)))
+    ),
+    'GetReportRequestList': Case(
+        lambda: fixtures.load('GetReportRequestList', fixtures.report_request_list, count=100),
+        lambda body: len(parse_report_request_list(AmzXmlResponse(body, stream=True)))
+    ),
+    'GetReport': Case(
+        lambda: fixtures.load('GetReport', fixtures.inventory_report, count=40000),
+        lambda body: len(parse_report(body, '_GET_FBA_MYI_UNSUPPRESSED_INVENTORY_DATA_'))
+    ),
+}
+
+
+########################################################################################################################
+
+
+def percentile(values, fraction):
+    """Return the value at :fraction: (0-1) of the sorted values."""
+    values = sorted(values)
+    return values[min(int(round(fraction * (len(values) - 1))), len(values) - 1)]
+
+
+def max_rss():
+    """Return the maximum resident set size of this process so far, in bytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def case_memory(name):
+    """Parse case :name: once, and return how much the maximum resident set size grew while parsing, in bytes. Call it
+    in a fresh interpreter (see measure_memory()), so earlier rounds don't hide the peak."""
+    case = CASES[name]
+    body = case.load()
+
+    before = max_rss()
+    case.parse(body)
+    return max_rss() - before
+
+
+def measure_memory(name):
+    """Run case_memory() for case :name: in a subprocess, and return the result."""
+    output = subprocess.run(
+        [sys.executable, '-m', 'benchmarks', '--memory-of', name],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdout=subprocess.PIPE,
+        check=True,
+        universal_newlines=True
+    ).stdout
+
+    return int(output.split()[-1])
+
+
+def run_case(name, min_time=1.0, min_rounds=5):
+    """Run case :name: repeatedly for at least :min_time: seconds and :min_rounds: rounds, then measure its peak memory
+    in a subprocess, and return its statistics."""
+    case = CASES[name]
+    body = case.load()
+    size = len(body.encode()) if isinstance(body, str) else len(body)
+    latencies, items = [], 0
+
+    case.parse(body)  # Warm up
+    started = time.perf_counter()
+    while len(latencies) < min_rounds or time.perf_counter() - started < min_time:
+        start = time.perf_counter()
+        items = case.parse(body)
+        latencies.append(time.perf_counter() - start)
+
+    mean = sum(latencies) / len(latencies)
+    return {
+        'rounds': len(latencies),
+        'size': size,
+        'items': items,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'mb_per_second': size / mean / 1e6,
+        'items_per_second': items / mean,
+        'peak_memory': measure_memory(name)
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of regressions in :results: compared to :baseline:."""
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+
+        for key, slack in (('p50', 0), ('peak_memory', MEMORY_SLACK)):
+            limit = baseline[name][key] * (1 + tolerance) + slack
+            if stats[key] > limit:
+                regressions.append(f'{name}: {key} is {stats[key]:.6g}, baseline is {baseline[name][key]:.6g}')
+
+    return regressions
+
+
+########################################################################################################################
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmark the response parsers.')
+    parser.add_argument('cases', nargs='*', help='the cases to run (default: all)')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='the baseline file to compare against')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed regression, as a fraction')
+    parser.add_argument('--min-time', type=float, default=1.0, help='minimum seconds to run each case')
+    parser.add_argument('--memory-of', metavar='CASE', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.memory_of:
+        print(case_memory(args.memory_of))
+        return 0
+
+    unknown = set(args.cases) - set(CASES)
+    if unknown:
+        parser.error(f'Unknown cases: {", ".join(sorted(unknown))}')
+
+    results = {}
+    print(f'{"case":<30}{"size":>12}{"items":>8}{"p50 ms":>10}{"p99 ms":>10}{"MB/s":>8}{"items/s":>10}{"peak KB":>10}')
+    for name in args.cases or CASES:
+        stats = results[name] = run_case(name, min_time=args.min_time)
+        print(f'{name:<30}{stats["size"]:>12}{stats["items"]:>8}{stats["p50"] * 1000:>10.3f}'
+              f'{stats["p99"] * 1000:>10.3f}{stats["mb_per_second"]:>8.1f}{stats["items_per_second"]:>10.0f}'
+              f'{stats["peak_memory"] / 1024:>10.0f}')
+
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+
+        with open(args.baseline, 'w') as f:
+            json.dump({**baseline, **results}, f, indent=2, sort_keys=True)
+
+        print(f'Saved baseline to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --save on this machine to create one')
+        return 2
+
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,186 @@
+"""A local stand-in for the MWS and Product Advertising APIs, for load and throttle testing.
+
+Run it from the web directory:
+
+    python -m benchmarks.fake_mws --port 8100 --latency 0.2
+
+and point the workers at it with MWS_ENDPOINT=http://localhost:8100. Every request is answered from the generators in
+benchmarks.fixtures, after enforcing the documented quota and restore rate of its operation. Requests over the quota
+get a 503 RequestThrottled error, like the real thing. Signatures are not checked.
+
+Throttle state is kept in memory, so run a single process (the server is threaded).
+"""
+import time
+import random
+import argparse
+import datetime
+import threading
+import itertools
+
+from flask import Flask, request, Response
+
+from benchmarks import fixtures
+
+
+########################################################################################################################
+
+
+# The documented throttling limits: (quota_max, seconds to restore one request, requests per hour or None)
+QUOTAS = {
+    'GetServiceStatus': (2, 300, None),
+    'ListMatchingProducts': (20, 5, 720),
+    'GetMyFeesEstimate': (20, 0.1, 36000),
+    'GetCompetitivePricingForASIN': (20, 0.1, 36000),
+    'ListInventorySupply': (30, 0.5, None),
+    'RequestReport': (15, 60, None),
+    'GetReportRequestList': (10, 45, 80),
+    'GetReport': (15, 60, 60),
+    'ItemLookup': (1, 1, None)
+}
+
+
+class Bucket:
+    """A thread-safe token bucket for a single operation, with an optional hourly request quota."""
+
+    def __init__(self, quota_max, restore_rate, hourly=None):
+        self.quota_max = quota_max
+        self.restore_rate = restore_rate
+        self.hourly = hourly
+        self.level = 0
+        self.updated = time.monotonic()
+        self.hour, self.hour_count = None, 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Count a request against the quota. Returns whether the request is allowed, and the quota headers to send."""
+        with self.lock:
+            now = time.monotonic()
+            self.level = max(self.level - (now - self.updated) / self.restore_rate, 0)
+            self.updated = now
+
+            headers = {}
+            if self.hourly:
+                hour = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+                if hour != self.hour:
+                    self.hour, self.hour_count = hour, 0
+
+                headers = {
+                    'x-mws-quota-max': str(self.hourly),
+                    'x-mws-quota-remaining': str(max(self.hourly - self.hour_count - 1, 0)),
+                    'x-mws-quota-resetsOn': (hour + datetime.timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+                }
+
+                if self.hour_count >= self.hourly:
+                    return False, headers
+
+            if self.level + 1 > self.quota_max:
+                return False, headers
+
+            self.level += 1
+            self.hour_count += 1
+            return True, headers
+
+
+########################################################################################################################
+
+
+app = Flask(__name__)
+settings = {'latency': 0, 'report_delay': 30, 'report_lines': 40000}
+buckets = {action: Bucket(*limits) for action, limits in QUOTAS.items()}
+reports, reports_lock, report_ids = {}, threading.Lock(), itertools.count(50000000000, 2)
+
+
+def list_param(prefix):
+    """Return the values of an MWS list parameter, like ASINList.ASIN.1, ASINList.ASIN.2..., in order."""
+    values = [(k, v) for k, v in request.values.items() if k.startswith(prefix + '.')]
+    return [v for k, v in sorted(values, key=lambda kv: [int(p) if p.isdigit() else p for p in kv[0].split('.')])]
+
+
+def report_status(request_id):
+    """Return the (request_id, type, status, report_id) tuple for a requested report, which is done once the report
+    delay has passed."""
+    report_type, submitted = reports[request_id]
+    if time.monotonic() - submitted < settings['report_delay']:
+        return request_id, report_type, '_IN_PROGRESS_', None
+
+    return request_id, report_type, '_DONE_', request_id + 1
+
+
+def respond(action):
+    """Build the response body for :action:, from the request parameters."""
+    if action == 'GetServiceStatus':
+        return fixtures.service_status()
+    elif action == 'ListMatchingProducts':
+        return fixtures.list_matching_products(count=10, seed=request.values.get('Query'))
+    elif action == 'GetCompetitivePricingForASIN':
+        return fixtures.competitive_pricing(asins=list_param('ASINList'))
+    elif action == 'GetMyFeesEstimate':
+        prefix = 'FeesEstimateRequestList.FeesEstimateRequest'
+        return fixtures.fees_estimate([
+            (request.values.get(f'{prefix}.{n}.Identifier'), request.values.get(f'{prefix}.{n}.IdValue'),
+             request.values.get(f'{prefix}.{n}.PriceToEstimateFees.ListingPrice.Amount'))
+            for n in itertools.takewhile(lambda n: f'{prefix}.{n}.IdValue' in request.values, itertools.count(1))
+        ])
+    elif action == 'ItemLookup':
+        return fixtures.item_lookup(asins=[i.strip() for i in request.values.get('ItemId', '').split(',') if i])
+    elif action in ('ListInventorySupply', 'ListInventorySupplyByNextToken'):
+        page = int(request.values.get('NextToken', 'page0')[4:])
+        return fixtures.inventory_supply(count=50, seed=page, next_token=f'page{page + 1}' if page < 9 else None)
+    elif action == 'RequestReport':
+        with reports_lock:
+            request_id = next(report_ids)
+            reports[request_id] = (request.values.get('ReportType'), time.monotonic())
+        return fixtures.request_report(request_id, reports[request_id][0])
+    elif action in ('GetReportRequestList', 'GetReportRequestListByNextToken'):
+        ids = [int(i) for i in list_param('ReportRequestIdList')] or list(reports)
+        return fixtures.report_request_list(
+            has_next=False,
+            requests=[report_status(i) for i in ids if i in reports]
+        )
+    elif action == 'GetReport':
+        return fixtures.inventory_report(count=settings['report_lines'], seed=request.values.get('ReportId'))
+
+    return None
+
+
+@app.route('/', methods=['GET', 'POST'])
+@app.route('/<path:path>', methods=['GET', 'POST'])
+def api(path=None):
+    action = request.values.get('Action') or request.values.get('Operation')
+    bucket = buckets.get(action.replace('ByNextToken', '') if action else None)
+
+    if settings['latency']:
+        time.sleep(random.uniform(0.5, 1.5) * settings['latency'])
+
+    allowed, headers = bucket.take() if bucket else (True, {})
+    if not allowed:
+        body = fixtures.error_response('RequestThrottled', 'Request is throttled')
+        return Response(body, status=503, headers=headers, mimetype='text/xml')
+
+    body = respond(action)
+    if body is None:
+        body = fixtures.error_response('InvalidParameterValue', f'Unsupported action: {action}')
+        return Response(body, status=400, mimetype='text/xml')
+
+    mimetype = 'text/plain' if action == 'GetReport' else 'text/xml'
+    return Response(body, headers=headers, mimetype=mimetype)
+
+
+########################################################################################################################
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.fake_mws', description='Run a fake MWS/PA server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--latency', type=float, default=0, help='average response latency, in seconds')
+    parser.add_argument('--report-delay', type=float, default=30, help='seconds until requested reports are done')
+    parser.add_argument('--report-lines', type=int, default=40000, help='number of lines in each report')
+    args = parser.parse_args(argv)
+
+    settings.update(latency=args.latency, report_delay=args.report_delay, report_lines=args.report_lines)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+import os
+import random
+
+
+########################################################################################################################
+
+
+# Recorded responses can be dropped in here, named after the fixture (e.g. ListMatchingProducts.xml). They are used
+# instead of the generated ones, and should be anonymised first.
+RECORDED_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+PRODUCTS_NS = 'http://mws.amazonservices.com/schema/Products/2011-10-01'
+ATTRIBUTES_NS = 'http://mws.amazonservices.com/schema/Products/2011-10-01/default.xsd'
+INVENTORY_NS = 'http://mws.amazonaws.com/FulfillmentInventory/2010-10-01'
+REPORTS_NS = 'http://mws.amazonaws.com/doc/2009-01-01/'
+PA_NS = 'http://webservices.amazon.com/AWSECommerceService/2013-08-01'
+
+
+def recorded(name):
+    """Return the recorded fixture for :name:, or None."""
+    for extension in ('.xml', '.txt', '.tsv'):
+        path = os.path.join(RECORDED_DIR, name + extension)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                return f.read()
+
+    return None
+
+
+def asin(rng):
+    return 'B0' + ''.join(rng.choice('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(8))
+
+
+def words(rng, count):
+    return ' '.join(rng.choice(('deluxe', 'widget', 'stainless', 'steel', 'kit', 'pack', 'pro', 'mini', 'organic',
+                                'cotton', 'wireless', 'charger', 'case', 'blue', 'large')) for _ in range(count))
+
+
+########################################################################################################################
+
+
+def list_matching_products(count=10, seed=0):
+    """A ListMatchingProducts response with :count: products, each with a full set of item attributes."""
+    rng = random.Random(seed)
+    products = []
+
+    for _ in range(count):
+        features = ''.join(f'<ns2:Feature>{words(rng, 12)}</ns2:Feature>' for _ in range(5))
+        ranks = ''.join(
+            f'<SalesRank><ProductCategoryId>{category}</ProductCategoryId><Rank>{rng.randint(1, 500000)}</Rank>'
+            f'</SalesRank>'
+            for category in ('home_garden_display_on_website', str(rng.randint(1000, 99999)))
+        )
+        products.append(
+            f'<Product><Identifiers><MarketplaceASIN><MarketplaceId>ATVPDKIKX0DER</MarketplaceId>'
+            f'<ASIN>{asin(rng)}</ASIN></MarketplaceASIN></Identifiers><AttributeSets>'
+            f'<ns2:ItemAttributes xml:lang="en-US"><ns2:Binding>Kitchen</ns2:Binding>'
+            f'<ns2:Brand>{words(rng, 1).title()}</ns2:Brand><ns2:Color>Black</ns2:Color>{features}'
+            f'<ns2:ItemDimensions><ns2:Height Units="inches">3.1</ns2:Height>'
+            f'<ns2:Length Units="inches">9.2</ns2:Length><ns2:Width Units="inches">4.4</ns2:Width>'
+            f'<ns2:Weight Units="pounds">1.2</ns2:Weight></ns2:ItemDimensions><ns2:Label>Acme</ns2:Label>'
+            f'<ns2:ListPrice><ns2:Amount>{rng.uniform(5, 200):.2f}</ns2:Amount>'
+            f'<ns2:CurrencyCode>USD</ns2:CurrencyCode></ns2:ListPrice><ns2:Manufacturer>Acme</ns2:Manufacturer>'
+            f'<ns2:Model>M-{rng.randint(100, 9999)}</ns2:Model><ns2:NumberOfItems>1</ns2:NumberOfItems>'
+            f'<ns2:PackageQuantity>{rng.randint(1, 12)}</ns2:PackageQuantity>'
+            f'<ns2:PartNumber>P-{rng.randint(100, 9999)}</ns2:PartNumber>'
+            f'<ns2:ProductGroup>Kitchen</ns2:ProductGroup><ns2:Publisher>Acme</ns2:Publisher>'
+            f'<ns2:SmallImage><ns2:URL>http://ecx.images-amazon.com/images/I/{asin(rng)}._SL75_.jpg</ns2:URL>'
+            f'<ns2:Height Units="pixels">75</ns2:Height><ns2:Width Units="pixels">75</ns2:Width></ns2:SmallImage>'
+            f'<ns2:Studio>Acme</ns2:Studio><ns2:Title>{words(rng, 10).title()}</ns2:Title>'
+            f'</ns2:ItemAttributes></AttributeSets><Relationships/><SalesRankings>{ranks}</SalesRankings></Product>'
+        )
+
+    return (
+        f'<?xml version="1.0"?><ListMatchingProductsResponse xmlns="{PRODUCTS_NS}" xmlns:ns2="{ATTRIBUTES_NS}">'
+        f'<ListMatchingProductsResult><Products>{"".join(products)}</Products></ListMatchingProductsResult>'
+        f'<ResponseMetadata><RequestId>bench</RequestId></ResponseMetadata></ListMatchingProductsResponse>'
+    )
+
+
+def competitive_pricing(count=20, seed=0, asins=None):
+    """A GetCompetitivePricingForASIN response for :count: ASINs (or for :asins:), with one in ten failing."""
+    rng = random.Random(seed)
+    asins = asins or [asin(rng) for _ in range(count)]
+    results = []
+
+    for i, sku in enumerate(asins):
+        if i % 10 == 9:
+            results.append(
+                f'<GetCompetitivePricingForASINResult ASIN="{sku}" status="ClientError"><Error><Type>Sender</Type>'
+                f'<Code>InvalidParameterValue</Code><Message>ASIN {sku} is not valid for marketplace '
+                f'ATVPDKIKX0DER</Message></Error></GetCompetitivePricingForASINResult>'
+            )
+            continue
+
+        prices = ''.join(
+            f'<CompetitivePrice belongsToRequester="false" condition="{condition}" subcondition="{condition}">'
+            f'<CompetitivePriceId>{n}</CompetitivePriceId><Price><LandedPrice><CurrencyCode>USD</CurrencyCode>'
+            f'<Amount>{rng.uniform(5, 200):.2f}</Amount></LandedPrice><ListingPrice><CurrencyCode>USD</CurrencyCode>'
+            f'<Amount>{rng.uniform(5, 200):.2f}</Amount></ListingPrice><Shipping><CurrencyCode>USD</CurrencyCode>'
+            f'<Amount>0.00</Amount></Shipping></Price></CompetitivePrice>'
+            for n, condition in enumerate(('New', 'Used'), 1)
+        )
+        results.append(
+            f'<GetCompetitivePricingForASINResult ASIN="{sku}" status="Success"><Product><Identifiers>'
+            f'<MarketplaceASIN><MarketplaceId>ATVPDKIKX0DER</MarketplaceId><ASIN>{sku}</ASIN></MarketplaceASIN>'
+            f'</Identifiers><CompetitivePricing><CompetitivePrices>{prices}</CompetitivePrices>'
+            f'<NumberOfOfferListings><OfferListingCount condition="New">{rng.randint(1, 40)}</OfferListingCount>'
+            f'<OfferListingCount condition="Any">{rng.randint(40, 60)}</OfferListingCount></NumberOfOfferListings>'
+            f'</CompetitivePricing><SalesRankings><SalesRank><ProductCategoryId>kitchen_display_on_website'
+            f'</ProductCategoryId><Rank>{rng.randint(1, 500000)}</Rank></SalesRank></SalesRankings></Product>'
+            f'</GetCompetitivePricingForASINResult>'
+        )
+
+    return (
+        f'<?xml version="1.0"?><GetCompetitivePricingForASINResponse xmlns="{PRODUCTS_NS}">{"".join(results)}'
+        f'<ResponseMetadata><RequestId>bench</RequestId></ResponseMetadata></GetCompetitivePricingForASINResponse>'
+    )
+
+
+def item_lookup(count=10, seed=0, asins=None):
+    """An ItemLookup response for :count: items (or for :asins:), with the response groups requested by
+    tasks.parsed.ItemLookup."""
+    rng = random.Random(seed)
+    asins = asins or [asin(rng) for _ in range(count)]
+    items = []
+
+    for sku in asins:
+        features = ''.join(f'<Feature>{words(rng, 12)}</Feature>' for _ in range(5))
+        similar = ''.join(
+            f'<SimilarProduct><ASIN>{asin(rng)}</ASIN><Title>{words(rng, 6)}</Title></SimilarProduct>'
+            for _ in range(5)
+        )
+        images = ''.join(
+            f'<{size}><URL>https://images-na.ssl-images-amazon.com/images/I/{sku}.jpg</URL>'
+            f'<Height Units="pixels">500</Height><Width Units="pixels">500</Width></{size}>'
+            for size in ('SwatchImage', 'SmallImage', 'ThumbnailImage', 'TinyImage', 'MediumImage', 'LargeImage')
+        )
+        items.append(
+            f'<Item><ASIN>{sku}</ASIN><DetailPageURL>https://www.amazon.com/dp/{sku}</DetailPageURL>'
+            f'<SalesRank>{rng.randint(1, 500000)}</SalesRank>{images}<ImageSets><ImageSet Category="primary">'
+            f'{images}</ImageSet></ImageSets><ItemAttributes><Binding>Kitchen</Binding><Brand>Acme</Brand>'
+            f'{features}<Label>Acme</Label><Manufacturer>Acme</Manufacturer><Model>M-{rng.randint(100, 9999)}</Model>'
+            f'<MPN>P-{rng.randint(100, 9999)}</MPN><NumberOfItems>1</NumberOfItems>'
+            f'<PackageQuantity>{rng.randint(1, 12)}</PackageQuantity><ProductGroup>Kitchen</ProductGroup>'
+            f'<Title>{words(rng, 10).title()}</Title><UPC>{rng.randint(10 ** 11, 10 ** 12 - 1)}</UPC>'
+            f'</ItemAttributes><OfferSummary><LowestNewPrice><Amount>{rng.randint(500, 20000)}</Amount>'
+            f'<CurrencyCode>USD</CurrencyCode><FormattedPrice>$1.00</FormattedPrice></LowestNewPrice>'
+            f'<TotalNew>{rng.randint(1, 40)}</TotalNew></OfferSummary><Offers><TotalOffers>1</TotalOffers><Offer>'
+            f'<Merchant><Name>Amazon.com</Name></Merchant><OfferListing><IsEligibleForPrime>1</IsEligibleForPrime>'
+            f'</OfferListing></Offer></Offers><EditorialReviews><EditorialReview><Source>Product Description'
+            f'</Source><Content>{words(rng, 80)}</Content></EditorialReview></EditorialReviews>'
+            f'<SimilarProducts>{similar}</SimilarProducts></Item>'
+        )
+
+    return (
+        f'<?xml version="1.0" ?><ItemLookupResponse xmlns="{PA_NS}"><OperationRequest><RequestId>bench</RequestId>'
+        f'</OperationRequest><Items><Request><IsValid>True</IsValid></Request>{"".join(items)}</Items>'
+        f'</ItemLookupResponse>'
+    )
+
+
+def inventory_supply(count=50, seed=0, next_token=True):
+    """A page of ListInventorySupply results with :count: members. :next_token: can be a token string, True for a
+    made-up token, or None for the last page."""
+    rng = random.Random(seed)
+    members = ''.join(
+        f'<member><SellerSKU>SKU-{rng.randint(10000, 99999)}</SellerSKU><ASIN>{asin(rng)}</ASIN>'
+        f'<TotalSupplyQuantity>{rng.randint(0, 500)}</TotalSupplyQuantity><FNSKU>X00{rng.randint(10 ** 6, 10 ** 7)}'
+        f'</FNSKU><Condition>NewItem</Condition><SupplyDetail/><InStockSupplyQuantity>{rng.randint(0, 500)}'
+        f'</InStockSupplyQuantity><EarliestAvailability><TimepointType>Immediately</TimepointType>'
+        f'</EarliestAvailability></member>'
+        for _ in range(count)
+    )
+    if next_token is True:
+        next_token = 't' * 200
+    token = f'<NextToken>{next_token}</NextToken>' if next_token else ''
+
+    return (
+        f'<?xml version="1.0"?><ListInventorySupplyResponse xmlns="{INVENTORY_NS}"><ListInventorySupplyResult>'
+        f'<InventorySupplyList>{members}</InventorySupplyList>{token}<MarketplaceId>ATVPDKIKX0DER</MarketplaceId>'
+        f'</ListInventorySupplyResult><ResponseMetadata><RequestId>bench</RequestId></ResponseMetadata>'
+        f'</ListInventorySupplyResponse>'
+    )
+
+
+def report_request_info(request_id, report_type, status, report_id=None):
+    """A single ReportRequestInfo element."""
+    generated = f'<GeneratedReportId>{report_id}</GeneratedReportId>' if report_id else ''
+    return (
+        f'<ReportRequestInfo><ReportRequestId>{request_id}</ReportRequestId><ReportType>{report_type}</ReportType>'
+        f'<StartDate>2018-06-01T10:00:00+00:00</StartDate><EndDate>2018-06-01T10:00:00+00:00</EndDate>'
+        f'<Scheduled>false</Scheduled><SubmittedDate>2018-06-01T10:00:00+00:00</SubmittedDate>'
+        f'<ReportProcessingStatus>{status}</ReportProcessingStatus>{generated}'
+        f'<StartedProcessingDate>2018-06-01T10:00:05+00:00</StartedProcessingDate>'
+        f'<CompletedDate>2018-06-01T10:00:35+00:00</CompletedDate></ReportRequestInfo>'
+    )
+
+
+def report_request_list(count=100, seed=0, has_next=True, requests=None):
+    """A page of GetReportRequestList results with :count: report requests, or with :requests:, a list of
+    (request_id, report_type, status, report_id) tuples."""
+    rng = random.Random(seed)
+    requests = requests if requests is not None else [
+        (rng.randint(10 ** 10, 10 ** 11), '_GET_FBA_MYI_UNSUPPRESSED_INVENTORY_DATA_', '_DONE_',
+         rng.randint(10 ** 10, 10 ** 11))
+        for _ in range(count)
+    ]
+    infos = ''.join(report_request_info(*request) for request in requests)
+
+    return (
+        f'<?xml version="1.0"?><GetReportRequestListResponse xmlns="{REPORTS_NS}"><GetReportRequestListResult>'
+        f'<NextToken>{"t" * 200}</NextToken><HasNext>{"true" if has_next else "false"}</HasNext>{infos}'
+        f'</GetReportRequestListResult><ResponseMetadata><RequestId>bench</RequestId></ResponseMetadata>'
+        f'</GetReportRequestListResponse>'
+    )
+
+
+def request_report(request_id, report_type):
+    """A RequestReport response."""
+    return (
+        f'<?xml version="1.0"?><RequestReportResponse xmlns="{REPORTS_NS}"><RequestReportResult>'
+        f'{report_request_info(request_id, report_type, "_SUBMITTED_")}</RequestReportResult>'
+        f'<ResponseMetadata><RequestId>bench</RequestId></ResponseMetadata></RequestReportResponse>'
+    )
+
+
+def fees_estimate(requests):
+    """A GetMyFeesEstimate response for :requests:, a list of (identifier, asin, price) tuples."""
+    results = ''.join(
+        f'<FeesEstimateResult><FeesEstimateIdentifier><MarketplaceId>ATVPDKIKX0DER</MarketplaceId>'
+        f'<IdType>ASIN</IdType><SellerId>bench</SellerId><SellerInputIdentifier>{identifier}'
+        f'</SellerInputIdentifier><IsAmazonFulfilled>true</IsAmazonFulfilled><IdValue>{sku}</IdValue>'
+        f'<PriceToEstimateFees><ListingPrice><Amount>{price}</Amount><CurrencyCode>USD</CurrencyCode></ListingPrice>'
+        f'</PriceToEstimateFees></FeesEstimateIdentifier><Status>Success</Status><FeesEstimate>'
+        f'<TotalFeesEstimate><Amount>{float(price or 0) * 0.15 + 3.19:.2f}</Amount><CurrencyCode>USD</CurrencyCode>'
+        f'</TotalFeesEstimate></FeesEstimate></FeesEstimateResult>'
+        for identifier, sku, price in requests
+    )
+
+    return (
+        f'<?xml version="1.0"?><GetMyFeesEstimateResponse xmlns="{PRODUCTS_NS}"><GetMyFeesEstimateResult>'
+        f'<FeesEstimateResultList>{results}</FeesEstimateResultList></GetMyFeesEstimateResult>'
+        f'<ResponseMetadata><RequestId>bench</RequestId></ResponseMetadata></GetMyFeesEstimateResponse>'
+    )
+
+
+def service_status():
+    """A GetServiceStatus response."""
+    return (
+        f'<?xml version="1.0"?><GetServiceStatusResponse xmlns="{PRODUCTS_NS}"><GetServiceStatusResult>'
+        f'<Status>GREEN</Status><Timestamp>2018-06-01T10:00:00.000Z</Timestamp></GetServiceStatusResult>'
+        f'<ResponseMetadata><RequestId>bench</RequestId></ResponseMetadata></GetServiceStatusResponse>'
+    )
+
+
+def error_response(code, message, error_type='Sender'):
+    """An MWS ErrorResponse."""
+    return (
+        f'<?xml version="1.0"?><ErrorResponse xmlns="https://mws.amazonservices.com/"><Error><Type>{error_type}'
+        f'</Type><Code>{code}</Code><Message>{message}</Message></Error><RequestID>bench</RequestID></ErrorResponse>'
+    )
+
+
+INVENTORY_REPORT_COLUMNS = (
+    'sku', 'fnsku', 'asin', 'product-name', 'condition', 'your-price', 'mfn-listing-exists',
+    'mfn-fulfillable-quantity', 'afn-listing-exists', 'afn-warehouse-quantity', 'afn-fulfillable-quantity',
+    'afn-unsellable-quantity', 'afn-reserved-quantity', 'afn-total-quantity', 'per-unit-volume',
+    'afn-inbound-working-quantity', 'afn-inbound-shipped-quantity', 'afn-inbound-receiving-quantity'
+)
+
+
+def inventory_report(count=40000, seed=0):
+    """A _GET_FBA_MYI_UNSUPPRESSED_INVENTORY_DATA_ report body with :count: lines."""
+    rng = random.Random(seed)
+    lines = ['\t'.join(INVENTORY_REPORT_COLUMNS)]
+
+    for _ in range(count):
+        quantities = [str(rng.randint(0, 200)) for _ in range(6)]
+        lines.append('\t'.join((
+            f'SKU-{rng.randint(10 ** 5, 10 ** 6)}', f'X00{rng.randint(10 ** 6, 10 ** 7)}', asin(rng),
+            words(rng, 10).title(), 'New', f'{rng.uniform(5, 200):.2f}', rng.choice(('Yes', 'No')), '',
+            'Yes', *quantities[:5], f'{rng.uniform(0.01, 2):.2f}', quantities[5], '0', '0'
+        )))
+
+    return '\n'.join(lines) + '\n'
+
+
+########################################################################################################################
+
+
+def load(name, generator, **kwargs):
+    """Return the recorded fixture for :name: if there is one, otherwise generate it."""
+    value = recorded(name)
+    return value if value is not None else generator(**kwargs)
@@ -33,5 +33,16 @@ class Config:
         'tasks.jobs.jobs'
     ]
     CELERYBEAT_MAX_LOOP_INTERVAL = 30
+    CELERYBEAT_SCHEDULE = {
+        # Restarts the report poller if its scheduled pass was lost while reports or chains were waiting
+        'poll_reports': {
+            'task': 'tasks.ops.reports.poll_reports',
+            'schedule': 10 * 60
+        }
+    }
     REDBEAT_LOCK_TIMEOUT = 150
     CELERYD_PREFETCH_MULTIPLIER = 1
+
+    # Route MWS and parsed tasks to the io queues, for use with supervisord_worker_gevent.conf. Only tasks sent as their
+    # own messages are routed; calls that ops tasks make directly still run in the ops task's prefork worker.
+    IO_WORKER_QUEUES = os.environ.get('IO_WORKER_QUEUES', '').lower() in ('1', 'true', 'yes')
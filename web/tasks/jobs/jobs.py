@@ -1,14 +1,14 @@
+import asyncio
 from datetime import datetime, timedelta
 from celery.utils.log import get_task_logger
 from app import celery_app, db
 from app.models import Product, Vendor, AmzReport, FBAManageInventoryReportLine, Spider
-from tasks.ops.products import store_product_history, update_amazon_listing, update_fba_fees, get_inventory
+from tasks.ops.products import store_product_history, update_amazon_listing, update_fba_fees, get_inventory,\
+    refresh_amazon_listings, vendor_domains, vendor_for_url
 from tasks.ops.reports import await_reports
 from tasks.parsed.products import GetCompetitivePricingForASIN
 from tasks.parsed.product_adv import ItemLookup
 
-from urllib.parse import urlparse
-
 
 logger = get_task_logger(__name__)
 DEFAULT_PRIORITY = 1
@@ -47,6 +47,26 @@ def track_amazon_products(self, *args, **kwargs):
         ).apply_async()
 
 
+@celery_app.task(bind=True, ignore_result=True)
+def refresh_amazon_products(self, *args, concurrency=20, **kwargs):
+    """Like track_amazon_products, but refreshes every product from one long-running coroutine pool instead of sending
+    a chain of Celery tasks per product. Meant for large, scheduled sweeps."""
+    products = Product.build_query(*args, **kwargs).filter(
+        Product.vendor_id == Vendor.get_amazon().id
+    ).with_entities(
+        Product.id,
+        Product.sku
+    ).all()
+
+    asyncio.run(
+        refresh_amazon_listings(
+            [tuple(p) for p in products],
+            priority=DEFAULT_PRIORITY,
+            concurrency=int(concurrency)
+        )
+    )
+
+
 @celery_app.task(bind=True, ignore_result=True)
 def update_inventory(self):
     """Download an inventory report from Amazon and import the products."""
@@ -78,12 +98,11 @@ def crawl_url(self, url, spider_id=None):
     if spider_id:
         spider = Spider.query.filter_by(id=spider_id).one()
     else:
-        spider = db.session.query(
-            Spider
-        ).filter(
-            Vendor.website.ilike(f'%{urlparse(url)[1]}%'),
-            Spider.vendor_id == Vendor.id
-        ).one()
+        vendor_id = vendor_for_url(url, vendor_domains())
+        if vendor_id is None:
+            raise ValueError(f'No vendor for {url}')
+
+        spider = Spider.query.filter_by(vendor_id=vendor_id).one()
 
     spider.crawl_url(url)
 
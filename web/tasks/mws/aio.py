@@ -0,0 +1,155 @@
+import os
+import asyncio
+import collections
+import aiohttp
+import redis.asyncio as aioredis
+
+from celery.five import monotonic
+from .common import MWSTask, acquire_usage_script, release_usage_script, quota_headers
+
+
+########################################################################################################################
+
+
+PreparedRequest = collections.namedtuple('PreparedRequest', ['method', 'kwargs'])
+
+
+########################################################################################################################
+
+
+class QuotaBucket:
+    """An in-process token bucket for a single API operation, kept in sync with the redis usage hash used by MWSTask.
+
+    Each request takes a token through the same acquire script as MWSTask, which returns how long to wait for the quota
+    to be restored, and gives it back through the same release script. Within the process, no more than quota_max
+    requests for the operation are waiting or in flight at once."""
+
+    def __init__(self, client, task, priority=0):
+        self.client = client
+        self.usage_key = task.name + '_usage'
+        self.pending_expires = task.pending_expires
+        self.limits = task.load_throttle_limits(priority)
+        self.tokens = asyncio.Semaphore(max(int(self.limits['quota_max']), 1))
+
+    async def acquire(self):
+        """Wait until a request can be made without exceeding the quota. Low priority clients yield to higher priority
+        calls that are waiting for quota, and try again afterwards. If the wait is cancelled, the request counted as
+        pending by the acquire script is given back."""
+        await self.tokens.acquire()
+        pending = False
+
+        try:
+            while True:
+                values = await self.client.acquire_script(
+                    keys=[self.usage_key],
+                    args=[monotonic(), self.limits['restore_rate'], self.limits['burst_max'], self.pending_expires,
+                          self.limits['quota_reserved'], self.limits['band']]
+                )
+                pending = not int(values[4])
+                await asyncio.sleep(float(values[3]))
+
+                if pending:
+                    break
+        except BaseException:
+            if pending:
+                await self.release(quota_used=0)
+            else:
+                self.tokens.release()
+            raise
+
+    async def release(self, quota_used=1, headers=None, throttled=False):
+        """Count a completed request against the quota, syncing the quota level from the response's quota headers."""
+        try:
+            await self.client.release_script(
+                keys=[self.usage_key],
+                args=[monotonic(), self.limits['restore_rate'], quota_used, self.limits['burst_max'], int(throttled),
+                      self.limits['band'], *quota_headers(headers or {})]
+            )
+        finally:
+            self.tokens.release()
+
+
+########################################################################################################################
+
+
+class AsyncMWSClient:
+    """Makes MWS and Product Advertising API calls from asyncio coroutines, for bulk jobs where a Celery task per call
+    would cost more than the call itself. Requests are built and signed by the same amz_mws API objects as MWSTask, and
+    throttled against the same usage hashes, so bulk jobs and the Celery workers share each operation's quota.
+
+    Use it as an async context manager:
+
+        async with AsyncMWSClient() as client:
+            xml = await client.call(products.GetCompetitivePricingForASIN, MarketplaceId=market_id, ASINList=asins)
+    """
+    throttled_retries = 3
+
+    def __init__(self, concurrency=20, priority=0):
+        self.concurrency = concurrency
+        self.priority = priority
+        self.redis = aioredis.from_url(os.environ.get('CELERY_REDIS_URL', 'redis://'))
+        self.acquire_script = self.redis.register_script(acquire_usage_script)
+        self.release_script = self.redis.register_script(release_usage_script)
+        self.session = None
+
+        self._requests = asyncio.Semaphore(concurrency)
+        self._apis = {}
+        self._buckets = {}
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=MWSTask.request_timeout[0],
+                sock_read=MWSTask.request_timeout[1]
+            )
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+        await self.redis.connection_pool.disconnect()
+
+    def bucket(self, task):
+        """Return the QuotaBucket for :task:'s operation."""
+        if task.name not in self._buckets:
+            self._buckets[task.name] = QuotaBucket(self, task, self.priority)
+
+        return self._buckets[task.name]
+
+    def prepare(self, task, *args, **kwargs):
+        """Build and sign the request for a call to :task:'s operation, without sending it."""
+        if task.api_name not in self._apis:
+            self._apis[task.api_name] = task.build_api(lambda method, **kw: PreparedRequest(method, kw))
+
+        request = getattr(self._apis[task.api_name], task.action_name)(*args, **kwargs)
+        if MWSTask.endpoint and 'url' in request.kwargs:
+            request.kwargs['url'] = MWSTask.endpoint_url(request.kwargs['url'])
+
+        return request
+
+    async def call(self, task, *args, **kwargs):
+        """Call the API operation behind :task: (an MWSTask, like tasks.mws.products.ListMatchingProducts) and return
+        the response body. Throttled requests are retried after the operation's restore rate."""
+        bucket = self.bucket(task)
+
+        for attempt in range(self.throttled_retries + 1):
+            await bucket.acquire()
+            body, headers = None, None
+
+            try:
+                # Sign the request after waiting for quota, so the timestamp is current
+                request = self.prepare(task, *args, **kwargs)
+                async with self._requests:
+                    async with self.session.request(request.method, **request.kwargs) as response:
+                        body, headers = await response.text(), response.headers
+            finally:
+                throttled = body is not None and MWSTask.response_error_code(body) == 'RequestThrottled'
+                await bucket.release(headers=headers, throttled=throttled)
+
+            if not throttled:
+                break
+
+            # The release script has blocked the operation for a restore period, so the next acquire() will wait
+
+        return body
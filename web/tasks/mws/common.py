@@ -1,12 +1,19 @@
+import re
+import zlib
 import hashlib
 import json
 import redis
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit, urlunsplit
 import os
 import time
+import uuid
+import datetime
+import functools
 import amazonmws as amz_mws
 
-from app import celery_app
+from app import celery_app, Throttled
 from celery.five import monotonic
 
 
@@ -89,15 +96,219 @@ mws_priority_limits = {
 ########################################################################################################################
 
 
+_session, _session_pid = None, None
+
+
+def http_session():
+    """Return a pooled, keep-alive requests session for the current worker process. Sessions are not shared across
+    forks, because the pooled connections would be."""
+    global _session, _session_pid
+
+    if _session is None or _session_pid != os.getpid():
+        pool_size = int(os.environ.get('MWS_POOL_SIZE', 10))
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=False)
+
+        _session = requests.Session()
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+        _session_pid = os.getpid()
+
+    return _session
+
+
+########################################################################################################################
+
+
+# The usage hash for each operation holds the quota level as of the last request, the time of the last request, and
+# the number of requests waiting to be made. The scripts below restore the quota level based on the elapsed time and
+# the restore rate. The hash also holds a blocked_until time after a RequestThrottled error or when an hourly quota runs
+# out. Operations with an hourly quota report it in their response headers; that's kept in hourly_max,
+# hourly_remaining and hourly_reset, separately from the burst quota level.
+
+# Requests are made in one of two bands: 'high' for interactive calls (priority >= MWSTask.reserve_priority) and 'low'
+# for everything else. Each band has its own pending counter. quota_max is the operation's burst quota. Low band
+# callers are kept below quota_max - reserved, so the rest of the quota is always available to the high band, and high
+# band callers don't queue behind them.
+
+# Increment the band's pending counter, and return the usage along with how long to wait before making the request. A
+# low band caller that would have to wait while high band calls are pending is told to yield instead, and its pending
+# counter is not incremented.
+# Call like so: EVALSHA sha 1 usage_key current_time restore_rate quota_max expires reserved band
+acquire_usage_script = """
+local usage = redis.call('HMGET', KEYS[1], 'quota_level', 'pending', 'last_request', 'blocked_until', 'pending_high')
+local now = tonumber(ARGV[1])
+local restore_rate = tonumber(ARGV[2])
+local high = ARGV[6] == 'high'
+local quota_max = tonumber(ARGV[3]) - (high and 0 or tonumber(ARGV[5]))
+local quota_level = tonumber(usage[1]) or 0
+local last_request = tonumber(usage[3]) or 0
+local blocked_until = tonumber(usage[4]) or 0
+local pending_high = tonumber(usage[5]) or 0
+local pending = pending_high
+
+if not high then
+    pending = pending + (tonumber(usage[2]) or 0)
+end
+
+if last_request > 0 and restore_rate > 0 then
+    quota_level = math.max(quota_level - (now - last_request) / restore_rate, 0)
+end
+
+local wait = math.max(quota_level + pending + 1 - quota_max, 0) * restore_rate
+wait = math.max(wait, blocked_until - now)
+
+if not high and wait > 0 and pending_high > 0 then
+    return {tostring(quota_level), pending, tostring(last_request), tostring(wait), 1}
+end
+
+redis.call('HINCRBY', KEYS[1], high and 'pending_high' or 'pending', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+
+return {tostring(quota_level), pending, tostring(last_request), tostring(wait), 0}
+"""
+
+# Decrement the band's pending counter, and add the quota used by the request (0 or 1) to the quota level. If the
+# request was throttled, the quota level is raised to quota_max and the operation is blocked for one restore period.
+# If the response carried hourly quota headers, they are stored, and the operation is blocked until the hourly quota
+# resets once it runs out. The headers never change the burst quota level.
+# Call like so: EVALSHA sha 1 usage_key current_time restore_rate quota_used quota_max throttled band hourly_remaining
+#   hourly_max reset_in
+# The last three arguments can be empty strings if the response had no quota headers.
+release_usage_script = """
+local usage = redis.call('HMGET', KEYS[1], 'quota_level', 'last_request', 'blocked_until')
+local now = tonumber(ARGV[1])
+local restore_rate = tonumber(ARGV[2])
+local quota_used = tonumber(ARGV[3])
+local quota_max = tonumber(ARGV[4])
+local throttled = ARGV[5] == '1'
+local pending_field = ARGV[6] == 'high' and 'pending_high' or 'pending'
+local hourly_remaining = tonumber(ARGV[7])
+local hourly_max = tonumber(ARGV[8])
+local reset_in = tonumber(ARGV[9])
+local quota_level = tonumber(usage[1]) or 0
+local last_request = tonumber(usage[2]) or 0
+local blocked_until = tonumber(usage[3]) or 0
+
+if quota_used > 0 then
+    if last_request > 0 and restore_rate > 0 then
+        quota_level = math.max(quota_level - (now - last_request) / restore_rate, 0)
+    end
+
+    quota_level = quota_level + quota_used
+
+    if throttled then
+        quota_level = math.max(quota_level, quota_max)
+        blocked_until = math.max(blocked_until, now + math.max(restore_rate, 1))
+    end
+
+    if hourly_remaining then
+        redis.call('HSET', KEYS[1], 'hourly_remaining', tostring(hourly_remaining))
+        if hourly_max then
+            redis.call('HSET', KEYS[1], 'hourly_max', tostring(hourly_max))
+        end
+        if reset_in then
+            redis.call('HSET', KEYS[1], 'hourly_reset', tostring(now + reset_in))
+            if hourly_remaining <= 0 then
+                blocked_until = math.max(blocked_until, now + reset_in)
+            end
+        end
+    end
+
+    redis.call('HSET', KEYS[1], 'quota_level', tostring(quota_level), 'last_request', tostring(now),
+               'blocked_until', tostring(blocked_until))
+end
+
+if redis.call('HINCRBY', KEYS[1], pending_field, -1) < 0 then
+    redis.call('HSET', KEYS[1], pending_field, 0)
+end
+
+return tostring(quota_level)
+"""
+
+
+# Release a single-flight lock if it is still held by the caller, and notify anybody waiting on the result
+# Call like so: EVALSHA sha 2 lock_key channel token
+end_flight_script = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+
+return redis.call('PUBLISH', KEYS[2], 1)
+"""
+
+
+# Look up a cached value, and count the hit or miss in the task's cache stats
+# Call like so: EVALSHA sha 3 cache_key fresh_key stats_key count
+cache_lookup_script = """
+local value = redis.call('GET', KEYS[1])
+local fresh = redis.call('EXISTS', KEYS[2])
+
+if ARGV[1] == '1' then
+    if value then
+        redis.call('HINCRBY', KEYS[3], 'hits', 1)
+        redis.call('HINCRBY', KEYS[3], 'hit_bytes', string.len(value))
+    else
+        redis.call('HINCRBY', KEYS[3], 'misses', 1)
+    end
+end
+
+return {value, fresh}
+"""
+
+error_code_re = re.compile(r'<ErrorResponse[\s>].*?<Code>([^<]*)</Code>', re.DOTALL)
+
+
+def quota_headers(headers):
+    """Return the hourly quota remaining, the hourly quota max, and the number of seconds until the hourly quota resets,
+    from the x-mws-quota-* headers of an MWS response. Missing values are returned as empty strings, ready to pass to
+    release_usage_script."""
+    remaining = headers.get('x-mws-quota-remaining', '')
+    quota_max = headers.get('x-mws-quota-max', '')
+    reset_in = ''
+
+    resets_on = headers.get('x-mws-quota-resetsOn')
+    if resets_on:
+        try:
+            resets_on = datetime.datetime.strptime(resets_on[:19], '%Y-%m-%dT%H:%M:%S')
+            reset_in = max((resets_on - datetime.datetime.utcnow()).total_seconds(), 0)
+        except ValueError:
+            pass
+
+    return remaining, quota_max, reset_in
+
+
+########################################################################################################################
+
+
 class MWSTask(celery_app.Task):
     """Common behaviors for all MWS API calls."""
     cache_ttl = None
+    cache_soft_ttl = None  # Cached values older than this are returned, but refreshed in the background
+    error_cache_ttl = None  # How long to cache error responses with one of the codes in cacheable_errors
+    cacheable_errors = ('InvalidParameterValue', 'InvalidRequest')
+    cache_max_size = 1024 * 1024  # Compressed values bigger than this (in bytes) are not cached
+    cache_compress_level = 6
     soft_time_limit = 30
     pending_expires = 200
-    restore_rate_adjust = 0
-    wait_adjust = 0
 
-    request_timeout = (10, 30)  # The connect and read timeouts for requests.get()
+    # Calls that would have to wait longer than this (in seconds) for their quota are rescheduled instead.
+    # None means always wait.
+    reschedule_after = float(os.environ['MWS_RESCHEDULE_AFTER']) if 'MWS_RESCHEDULE_AFTER' in os.environ else None
+
+    # Calls that can't be rescheduled get a RequestThrottled response instead of waiting longer than this (in seconds)
+    # for their quota, e.g. when the hourly quota has run out, so they don't hold up the worker.
+    max_wait = soft_time_limit / 2
+
+    reserve_priority = 2  # Calls with this priority or higher can use the quota reserved by load_throttle_limits()
+
+    # Send requests here instead of to Amazon, e.g. http://localhost:8100 for the fake server in benchmarks.fake_mws
+    endpoint = os.environ.get('MWS_ENDPOINT')
+
+    throttled_retries = 3  # How many times to retry a throttled request in the worker, when it can't be rescheduled
+    # How long to wait for an identical call in flight, before making the call anyway. Well under soft_time_limit, so a
+    # task that gives up waiting still has time to make its own call.
+    flight_timeout = soft_time_limit / 3
+    request_timeout = (10, 30)  # The connect and read timeouts for requests
 
     options = {
         'default_retry_delay': 10,
@@ -109,22 +320,31 @@ class MWSTask(celery_app.Task):
         )
     }
 
-    def _use_requests(self, method, **kwargs):
-        """Adapter function that lets the amazonmws library use requests."""
-        if method == 'POST':
-            return requests.post(**kwargs)
-        elif method == 'GET':
-            response = requests.get(**kwargs, timeout=self.request_timeout)
-            if response.status_code == 500:
-                self.retry()
-        else:
+    def _use_requests(self, method, stream=False, **kwargs):
+        """Adapter function that lets the amazonmws library use requests. With :stream: the response body is not
+        downloaded until it is read."""
+        if method not in ('GET', 'POST'):
             raise ValueError('Unsupported HTTP method: ' + method)
 
+        if self.endpoint and 'url' in kwargs:
+            kwargs['url'] = self.endpoint_url(kwargs['url'])
+
+        response = http_session().request(method, **kwargs, stream=stream, timeout=self.request_timeout)
+        if response.status_code == 500:
+            self.retry()
+
+        return response
+
     def __init__(self):
-        """Initialize the task object."""
+        """Initialize the task object. Everything set up here is shared by all calls to the task, so per-call values
+        are passed between methods instead of being stored on the task."""
         # Set up database connections here
         self.api = None
         self.redis = redis.from_url(os.environ.get('CELERY_REDIS_URL', 'redis://'))
+        self._acquire_script = self.redis.register_script(acquire_usage_script)
+        self._release_script = self.redis.register_script(release_usage_script)
+        self._end_flight_script = self.redis.register_script(end_flight_script)
+        self._cache_lookup_script = self.redis.register_script(cache_lookup_script)
         self._credentials = {
             'access_key': os.environ.get('MWS_ACCESS_KEY', 'test_access_key'),
             'secret_key': os.environ.get('MWS_SECRET_KEY', 'test_secret_key'),
@@ -136,171 +356,293 @@ class MWSTask(celery_app.Task):
           "account_id": os.environ.get('PA_ASSOCIATE_TAG', 'test_associate_tag')
         }
 
-        self._cache_key = None
-        self._cached_value = None
-        self._action_name = None
-        self._api_name = None
-        self._limits = {}
-        self._usage = {}
-
-    def __call__(self, *args, **kwargs):
-        """Perform the API call."""
-        self._api_name, self._action_name = self.name.split('.')[-2:]
-        if self._api_name == 'product_adv':
-            self._api_name = 'ProductAdvertising'
-        elif self._api_name == 'inventory':
-            self._api_name = 'FulfillmentInventory'
+        # The task decorator sets run() to the decorated class, so point it at the real implementation
+        self.run = self.call_api
+
+    @property
+    def action_name(self):
+        """The name of the API operation, taken from the task name."""
+        return self.name.split('.')[-1]
+
+    @property
+    def api_name(self):
+        """The name of the amz_mws API class, taken from the task's module name."""
+        module_name = self.name.split('.')[-2]
+        if module_name == 'product_adv':
+            return 'ProductAdvertising'
+        elif module_name == 'inventory':
+            return 'FulfillmentInventory'
         else:
-            self._api_name = self._api_name.capitalize()
+            return module_name.capitalize()
 
-        # Check the cache
-        if kwargs.pop('use_cache', True):
-            self._cache_key = self.build_cache_key(*args, **kwargs)
-            self._cached_value = self.get_cached_value()
+    def call_api(self, *args, use_cache=True, **kwargs):
+        """Return the cached response for this call, wait for an identical call that is already in flight, or make the
+        API call."""
+        cache_key = self.build_cache_key(*args, **kwargs)
+        flight_token = None
 
-        if self._cached_value is not None:
-            self.run = self.return_cached_value
-        else:
-            self.run = self.make_api_call
+        if use_cache and cache_key is not None:
+            value, fresh = self.lookup_cache(cache_key)
+            if value is not None:
+                if not fresh:
+                    self.revalidate(cache_key, *args, **kwargs)
+                return value
+
+            value, flight_token = self.join_flight(cache_key)
+            if value is not None:
+                return value
 
-        return super().__call__(*args, **kwargs)
+        try:
+            return self.make_api_call(cache_key, *args, **kwargs)
+        finally:
+            self.end_flight(cache_key, flight_token)
 
-    def return_cached_value(self, *args, **kwargs):
-        return self._cached_value
+    def join_flight(self, cache_key):
+        """Wait for an identical call that is already in flight to land in the cache. Returns a tuple of the cached
+        value and a flight token. If the value is None, the caller should make the call itself, and pass the token to
+        end_flight() when it's done. The flight lock is held for up to soft_time_limit, which is as long as the call
+        can take."""
+        lock_key, channel = cache_key + '_flight', cache_key + '_landed'
+        token = uuid.uuid4().hex
 
-    def load_usage(self):
-        """Load usage for this operation type, and increment the pending counter for this operation."""
-        usage_key = self.name + '_usage'
+        if self.redis.set(lock_key, token, nx=True, ex=int(self.soft_time_limit)):
+            return None, token
+
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
 
+        try:
+            deadline = monotonic() + self.flight_timeout
+            while monotonic() < deadline:
+                value = self.get_cached_value(cache_key)
+                if value is not None:
+                    return value, None
+
+                # The caller in flight might have failed
+                if self.redis.set(lock_key, token, nx=True, ex=int(self.soft_time_limit)):
+                    return None, token
+
+                pubsub.get_message(timeout=max(deadline - monotonic(), 0))
+        finally:
+            pubsub.close()
+
+        return None, None
+
+    def end_flight(self, cache_key, token):
+        """Release the flight lock taken in join_flight(), and wake up any callers waiting on the result."""
+        if token is None:
+            return
+
+        self._end_flight_script(
+            keys=[cache_key + '_flight', cache_key + '_landed'],
+            args=[token]
+        )
+
+    def load_usage(self, limits):
+        """Load usage for this operation type, increment the pending counter for this operation, and calculate how
+        long to wait before making the API call. If 'yield' is True in the returned usage, the caller should give way
+        to higher priority calls and try again after the wait; the pending counter was not incremented."""
+        usage_key = self.name + '_usage'
         now = monotonic()
-        restore_rate = self._limits['restore_rate']
-
-        # The script below restores the quota level based on the elapsed time and the restore rate
-        # Call like so: EVAL script 1 usage_key current_time restore_rate
-        script = f"""
-        local usage = redis.call('HMGET', '{usage_key}', 'quota_level', 'pending', 'last_request')
-        local quota_level = true and tonumber(usage[1]) or 0
-        local pending = true and tonumber(usage[2]) or 0
-        local last_request = true and tonumber(usage[3]) or 0
-        local restored = 0
-        
-        if last_request > 0 then
-            restored = ({now} - last_request) / {restore_rate}
-            quota_level = math.max(quota_level - restored, 0)
-            redis.call('HSET', '{usage_key}', 'quota_level', quota_level)
-        end
-        
-        redis.call('HINCRBY', '{usage_key}', 'pending', 1)
-        redis.call('EXPIRE', '{usage_key}', {self.pending_expires})
-        
-        return {{tostring(quota_level), pending, tostring(last_request), tostring(restored)}}
-        """
 
-        values = self.redis.eval(script, 0)
+        values = self._acquire_script(
+            keys=[usage_key],
+            args=[now, limits['restore_rate'], limits['burst_max'], self.pending_expires, limits['quota_reserved'],
+                  limits['band']]
+        )
 
         usage = {
             'quota_level': float(values[0]),
             'pending': int(values[1]),
-            'last_request': float(values[2])
+            'last_request': float(values[2]),
+            'wait': float(values[3]),
+            'yield': bool(values[4])
         }
 
-        self._usage = usage
         print(f"{usage_key}: "
               f"quota_level={usage['quota_level']} "
               f"pending={usage['pending']} "
               f"last_request={usage['last_request']} "
               f"now={now} "
-              f"restored={values[-1]}")
-
-    def calculate_wait(self):
-        """Calculate how long to sleep() before making the API call."""
-        quota_max = self._limits['quota_max']
-        restore_rate = self._limits['restore_rate']
-        quota_level = self._usage['quota_level']
-        pending = self._usage['pending']
+              f"wait={usage['wait']} "
+              f"band={limits['band']}")
 
-        return max((quota_level + pending + 1 - quota_max), 0) * restore_rate
+        return usage
 
-    def make_api_call(self, *args, **kwargs):
+    def make_api_call(self, cache_key, *args, **kwargs):
         """Make the api call, save the value to the cache, and update usage statistics."""
         priority = self.get_priority()
         kwargs.pop('priority', None)
 
         self.load_api()
-        self.load_throttle_limits(priority)
-        self.load_usage()
+        return_value = self.throttled_call(self.api, priority, *args, **kwargs).text
 
-        try:
-            wait = self.calculate_wait()
-            time.sleep(wait + self.wait_adjust)
-            return_value = getattr(self.api, self._action_name)(*args, **kwargs).text
-        except Exception as e:
-            self.save_usage()
-            raise e
-
-        self.save_usage()
-        self.save_to_cache(return_value)
+        self.save_to_cache(cache_key, return_value)
         return return_value
 
-    def save_usage(self):
-        """Update the usage stats in the cache."""
+    def stream_api_call(self, *args, priority=0, **kwargs):
+        """Make the api call without caching it or reading the response body, and return the response. The caller
+        reads the body incrementally (with iter_lines() or iter_content()) and closes the response."""
+        api = self.build_api(functools.partial(self._use_requests, stream=True))
+        return self.throttled_call(api, priority, *args, **kwargs)
+
+    def throttled_call(self, api, priority, *args, **kwargs):
+        """Wait for quota, call this task's operation through :api:, and count the call against the quota. Returns
+        the response. Throttled requests are retried after the restore period, up to throttled_retries times, and then
+        the throttled response is returned. If the task can be rescheduled (see can_reschedule()), it raises Throttled
+        instead of waiting. Otherwise, calls that would wait longer than max_wait get a RequestThrottled response
+        without being made."""
+        limits = self.load_throttle_limits(priority)
+        reschedule = self.can_reschedule()
+
+        for attempt in range(self.throttled_retries + 1):
+            if not self.wait_for_quota(limits, reschedule):
+                return self.throttled_response()
+
+            try:
+                response = getattr(api, self.action_name)(*args, **kwargs)
+            except Exception as e:
+                self.save_usage(limits)
+                raise e
+
+            # Throttled requests get a 503, so streamed responses only have their (small) body read when it's an error
+            throttled = response.status_code == 503 and self.response_error_code(response.text) == 'RequestThrottled'
+            self.save_usage(limits, response.headers, throttled)
+
+            if not throttled or attempt == self.throttled_retries:
+                break
+
+            response.close()
+            if reschedule:
+                raise Throttled(limits['restore_rate'] or 1, f'{self.action_name} request was throttled')
+
+            # The release script blocked the operation for a restore period, so the next wait_for_quota() waits
+
+        return response
+
+    def wait_for_quota(self, limits, reschedule=False):
+        """Sleep until the quota allows another call, counting the call as pending, and return True. With :reschedule:,
+        raise Throttled instead if the wait would be longer than reschedule_after, or if the quota is reserved for
+        higher priority calls. Without it, return False instead of waiting longer than max_wait."""
+        while True:
+            usage = self.load_usage(limits)
+            wait = usage['wait']
+
+            if usage['yield']:
+                if reschedule:
+                    raise Throttled(wait, f'{self.action_name} quota is reserved for higher priority calls')
+                if wait > self.max_wait:
+                    return False
+                time.sleep(wait)
+                continue
+
+            if reschedule and wait > self.reschedule_after:
+                self.release_usage(limits)
+                raise Throttled(wait)
+
+            if not reschedule and wait > self.max_wait:
+                self.release_usage(limits)
+                return False
+
+            # The call is counted as pending from here on, so give it back if the wait is interrupted (e.g. by the
+            # soft time limit)
+            try:
+                time.sleep(wait)
+            except BaseException:
+                self.release_usage(limits)
+                raise
+
+            return True
+
+    def throttled_response(self):
+        """Return a RequestThrottled error response, like the one Amazon sends, for a call that wasn't made because its
+        quota wouldn't allow it for too long."""
+        response = requests.Response()
+        response.status_code = 503
+        response.headers['Content-Type'] = 'text/xml'
+        response.encoding = 'utf-8'
+        response._content = (
+            f'<ErrorResponse><Error><Type>Receiver</Type><Code>RequestThrottled</Code><Message>{self.action_name} '
+            f'quota is not available for at least {self.max_wait:.0f} seconds</Message></Error></ErrorResponse>'
+        ).encode()
+        response._content_consumed = True
+
+        return response
+
+    def can_reschedule(self):
+        """Return True if a call that has to wait can raise Throttled instead. That's only when reschedule_after is
+        set, and the task running in the worker is a single API call (see ContextTask.throttle_units). Calls made by
+        any other task wait in the worker, so the rest of that task isn't repeated."""
+        task = celery_app.current_worker_task
+        return self.reschedule_after is not None and task is not None and task.name.startswith(task.throttle_units)
+
+    def save_usage(self, limits, headers=None, throttled=False):
+        """Count a completed request against the quota, and decrement the pending counter. The quota level is synced
+        from the response's quota headers, if it has them."""
         usage_key = self.name + '_usage'
-        now = monotonic()
-        restore_rate = self._limits['restore_rate']
-
-        # The script below restores the quota level based on the elapsed time and the restore rate
-        # Call like so: EVAL script 1 usage_key current_time restore_rate
-        script = f"""
-                local usage = redis.call('HMGET', '{usage_key}', 'quota_level', 'last_request')
-                local quota_level = true and tonumber(usage[1]) or 0
-                local last_request = true and tonumber(usage[2]) or 0
-                local restored = 0
-                
-                if last_request > 0 then
-                    local restored = ({now} - last_request) / {restore_rate}
-                    quota_level = math.max(quota_level - restored, 0)
-                    redis.call('HSET', '{usage_key}', 'quota_level', quota_level + 1)
-                end
-                
-                redis.call('HINCRBY', '{usage_key}', 'pending', -1)
-                redis.call('HSET', '{usage_key}', 'last_request', {now})
-                
-                return {{tostring(restored), tostring(last_request)}}
-                """
-
-        values = self.redis.eval(script, 0)
+        self._release_script(
+            keys=[usage_key],
+            args=[monotonic(), limits['restore_rate'], 1, limits['burst_max'], int(throttled), limits['band'],
+                  *quota_headers(headers or {})]
+        )
+
+    def release_usage(self, limits):
+        """Give up the pending request counted by load_usage(), without using any quota."""
+        usage_key = self.name + '_usage'
+        self._release_script(
+            keys=[usage_key],
+            args=[monotonic(), limits['restore_rate'], 0, limits['burst_max'], 0, limits['band'], '', '', '']
+        )
 
     def load_throttle_limits(self, priority):
-        """Load custom throttle limits based on a task's name and priority."""
+        """Return the throttle limits for this task, based on the task's name and priority. Calls below
+        reserve_priority are in the 'low' band, and the difference between their quota_max and the top priority's is
+        reserved for the 'high' band. burst_max is the operation's whole burst quota, shared by every band."""
         try:
-            priority_ceil = max(mws_priority_limits[self._action_name])
+            priority_ceil = max(mws_priority_limits[self.action_name])
         except KeyError:
             priority_ceil = 0
 
         try:
+            band = 'high' if int(priority) >= self.reserve_priority else 'low'
             priority = min(int(priority), priority_ceil)
         except TypeError:
             print(f'Invalid priority value: {priority}\nUsing default priority (0)')
-            priority = 0
+            band, priority = 'low', 0
 
-        self._limits = {
+        limits = {
             'quota_max': 1,
             'restore_rate': 0,
         }
 
-        self._limits.update(
-            **amz_mws.DEFAULT_LIMITS.get(self._action_name, {})
+        limits.update(
+            **amz_mws.DEFAULT_LIMITS.get(self.action_name, {})
         )
 
-        self._limits.update(
-            **mws_priority_limits.get(self._action_name, {}).get(priority, {})
+        limits.update(
+            **mws_priority_limits.get(self.action_name, {}).get(priority, {})
         )
 
+        top_quota_max = mws_priority_limits.get(self.action_name, {}).get(priority_ceil, {}).get('quota_max')
+        limits['band'] = band
+        limits['burst_max'] = max(top_quota_max or limits['quota_max'], limits['quota_max'])
+        limits['quota_reserved'] = limits['burst_max'] - limits['quota_max']
+
+        return limits
+
     def load_api(self):
-        """Loads the correct API object from amz_mws, based on the module name of the current task."""
-        self.api = getattr(amz_mws, self._api_name)(
-            **self._pa_credentials if self._api_name == 'ProductAdvertising' else self._credentials,
-            make_request=self._use_requests
+        """Loads the correct API object from amz_mws, based on the module name of the current task. The API object is
+        kept for the life of the task object."""
+        if self.api is not None:
+            return
+
+        self.api = self.build_api(self._use_requests)
+
+    def build_api(self, make_request):
+        """Build an amz_mws API object for this task's API, which sends its (signed) requests through make_request."""
+        return getattr(amz_mws, self.api_name)(
+            **self._pa_credentials if self.api_name == 'ProductAdvertising' else self._credentials,
+            make_request=make_request
         )
 
     def build_cache_key(self, *args, **kwargs):
@@ -317,26 +659,77 @@ class MWSTask(celery_app.Task):
 
             return f'{self.name}_{sig}'
 
-    def get_cached_value(self):
-        """Return the value in the cache corresponding to the given args and kwargs, or None."""
-        if not self.cache_ttl or not self.redis.exists(self._cache_key):
-            return None
+    def lookup_cache(self, cache_key, count=True):
+        """Return the cached value for :cache_key: (or None), and whether the value is still fresh, in a single round
+        trip. If :count: is True, the lookup is counted as a hit or miss in the task's cache stats."""
+        if not self.cache_ttl:
+            return None, False
+
+        value, fresh = self._cache_lookup_script(
+            keys=[cache_key, cache_key + '_fresh', self.name + '_cache_stats'],
+            args=[int(count)]
+        )
+
+        if value is None:
+            return None, False
+
+        return self.decompress(value), bool(fresh) or not self.cache_soft_ttl
+
+    def get_cached_value(self, cache_key):
+        """Return the value in the cache for :cache_key:, or None."""
+        return self.lookup_cache(cache_key, count=False)[0]
+
+    def revalidate(self, cache_key, *args, **kwargs):
+        """Refresh a stale cache value in the background. Only one refresh is queued at a time."""
+        if self.redis.set(cache_key + '_refresh', 1, nx=True, ex=int(self.flight_timeout)):
+            self.apply_async(args=args, kwargs={**kwargs, 'use_cache': False}, priority=kwargs.get('priority', 0))
+
+    def save_to_cache(self, cache_key, value):
+        """Save the value to the cache. Error responses are only cached if their code is in cacheable_errors."""
+        if not self.cache_ttl or not cache_key:
+            return
+
+        error_code = self.response_error_code(value)
+        if error_code is None:
+            ttl, soft_ttl = self.cache_ttl, self.cache_soft_ttl
+        elif error_code in self.cacheable_errors and self.error_cache_ttl:
+            ttl, soft_ttl = self.error_cache_ttl, self.error_cache_ttl
         else:
-            return self.redis.get(self._cache_key).decode()
+            return
 
-    def save_to_cache(self, value):
-        """Save the value to the cache."""
-        if self.cache_ttl:
-            self.redis.set(self._cache_key, value, ex=self.cache_ttl)
+        stats_key = self.name + '_cache_stats'
+        compressed = zlib.compress(value.encode(), self.cache_compress_level)
+        pipe = self.redis.pipeline()
 
-    def after_return(self, status, retval, task_id, args, kwargs, einfo):
-        """Clean up."""
-        self.api = None
-        self._cache_key = None
-        self._cached_value = None
-        self._action_name = None
-        self._api_name = None
-        self._limits = {}
-        self._usage = {}
+        if len(compressed) > self.cache_max_size:
+            pipe.hincrby(stats_key, 'too_large', 1)
+        else:
+            pipe.set(cache_key, compressed, ex=ttl)
+            if self.cache_soft_ttl:
+                pipe.set(cache_key + '_fresh', 1, ex=min(soft_ttl, ttl))
+
+            pipe.hincrby(stats_key, 'stored', 1)
+            pipe.hincrby(stats_key, 'stored_bytes', len(compressed))
+            pipe.hincrby(stats_key, 'raw_bytes', len(value))
 
+        pipe.execute()
 
+    @classmethod
+    def endpoint_url(cls, url):
+        """Point :url: at the configured endpoint, keeping its path and query."""
+        scheme, netloc = urlsplit(cls.endpoint)[:2]
+        return urlunsplit((scheme, netloc) + tuple(urlsplit(url)[2:]))
+
+    @staticmethod
+    def decompress(value):
+        """Decompress a cached value. Values cached before compression was added are returned as-is."""
+        try:
+            return zlib.decompress(value).decode()
+        except zlib.error:
+            return value.decode()
+
+    @staticmethod
+    def response_error_code(value):
+        """Return the error code if :value: is an MWS error response, otherwise None."""
+        match = error_code_re.search(value[:4096])
+        return match.group(1) if match else None
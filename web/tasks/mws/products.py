@@ -9,16 +9,17 @@ class GetServiceStatus(MWSTask):
     pass
 
 
-@celery_app.task(base=MWSTask, bind=True, cache_ttl=60 * 60 * 24, **MWSTask.options)
+@celery_app.task(base=MWSTask, bind=True, cache_ttl=60 * 60 * 24, error_cache_ttl=60 * 10, **MWSTask.options)
 class ListMatchingProducts(MWSTask):
     pass
 
 
-@celery_app.task(base=MWSTask, bind=True, cache_ttl=60 * 30, **MWSTask.options)
+@celery_app.task(base=MWSTask, bind=True, cache_ttl=60 * 30, error_cache_ttl=60 * 10, **MWSTask.options)
 class GetMyFeesEstimate(MWSTask):
     pass
 
 
-@celery_app.task(base=MWSTask, bind=True, cache_ttl=60 * 5, **MWSTask.options)
+@celery_app.task(base=MWSTask, bind=True, cache_ttl=60 * 15, cache_soft_ttl=60 * 5, error_cache_ttl=60 * 10,
+                 **MWSTask.options)
 class GetCompetitivePricingForASIN(MWSTask):
     pass
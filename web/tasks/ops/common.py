@@ -1,3 +1,5 @@
+import os
+import redis
 import sqlalchemy
 import pymysql
 import requests
@@ -23,3 +25,13 @@ class OpsTask(celery_app.Task):
             requests.exceptions.Timeout
         )
     }
+
+    _redis = None
+
+    @property
+    def redis(self):
+        """A redis client, for locks and signals shared between workers."""
+        if OpsTask._redis is None:
+            OpsTask._redis = redis.from_url(os.environ.get('CELERY_REDIS_URL', 'redis://'))
+
+        return OpsTask._redis
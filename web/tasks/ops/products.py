@@ -1,6 +1,8 @@
 import re
+import asyncio
 import collections
 import sqlalchemy
+from concurrent.futures import ThreadPoolExecutor
 import pymysql
 from datetime import datetime
 
@@ -9,17 +11,23 @@ from .common import *
 from celery.utils.log import get_task_logger
 from celery import group, chain, chord
 
-from app import db
+from app import app, db
 from app.models import Vendor, Product, QuantityMap, Opportunity, ProductHistory, AmzReportLineMixin, AmzReport,\
     FBAManageInventoryReportLine
 
 from sqlalchemy import func
-
-from tasks.parsed.products import ListMatchingProducts, GetCompetitivePricingForASIN, GetMyFeesEstimate
-from tasks.parsed.product_adv import ItemLookup
+from sqlalchemy.dialects import mysql
+
+from tasks.parsed.common import AmzXmlResponse, format_parsed_response
+from tasks.parsed.products import ListMatchingProducts, GetCompetitivePricingForASIN, GetMyFeesEstimate,\
+    fees_estimate_request, parse_competitive_pricing, parse_fees_estimate
+from tasks.parsed.product_adv import ItemLookup, parse_item_lookup
+import tasks.mws.products as mws_products
+import tasks.mws.product_adv as mws_product_adv
 from tasks.parsed.inventory import ListInventorySupply
 
 from urllib.parse import urlparse
+from amazonmws import MARKETID
 
 logger = get_task_logger(__name__)
 
@@ -67,6 +75,121 @@ def clean_and_import(self, data):
     find_amazon_matches.apply_async(args=(product.id,), priority=self.get_priority())
 
 
+@celery_app.task(bind=True, base=OpsTask, **OpsTask.options)
+def import_products(self, items):
+    """Clean and import a batch of scraped products in bulk. Vendors are looked up by the domain of each item's
+    detail_url (see vendor_for_url()), and every product is inserted or updated with one INSERT ... ON DUPLICATE KEY
+    UPDATE per set of fields. Items without a vendor or a sku are logged and skipped. Then find_amazon_matches() is
+    queued for every product, and guess_quantity() for the ones whose title or quantity_desc changed."""
+    columns = set(Product.__table__.columns.keys()) - {'id', 'extra', 'last_modified'}
+    vendors = vendor_domains()
+    rows = {}
+
+    for data in items:
+        data = {k: v.strip() if isinstance(v, str) else v for k, v in data.items()}
+
+        vendor_id = data.pop('vendor_id', None)
+        if vendor_id is None:
+            vendor_id = vendor_for_url(data.get('detail_url'), vendors)
+            if vendor_id is None:
+                logger.warning(f'Skipped an item with no vendor for detail_url {data.get("detail_url")!r}: {data}')
+                continue
+
+        if not data.get('sku'):
+            logger.warning(f'Skipped an item with no sku: {data}')
+            continue
+
+        # Later items for the same product replace earlier ones, like consecutive clean_and_import() calls would
+        row = {k: v for k, v in data.items() if k in columns}
+        row.update(vendor_id=vendor_id, extra={k: v for k, v in data.items() if k not in columns})
+        rows[vendor_id, row['sku']] = row
+
+    if not rows:
+        return
+
+    keys = db.tuple_(Product.vendor_id, Product.sku)
+    existing = {
+        (p.vendor_id, p.sku): p for p in db.session.query(
+            Product.vendor_id, Product.sku, Product.title, Product.quantity_desc
+        ).filter(keys.in_(list(rows))).all()
+    }
+
+    # Rows have to share the same fields to go into one INSERT
+    by_fields = collections.defaultdict(list)
+    for row in rows.values():
+        by_fields[tuple(sorted(row))].append(row)
+
+    for fields, batch in by_fields.items():
+        insert = mysql.insert(Product.__table__)
+
+        # MySQL applies these in order, so market_fees is compared with the old price before the price is updated.
+        # Like Product._maybe_clear_fees(), a new price without new fees clears the old fees.
+        update = []
+        if 'price' in fields and 'market_fees' not in fields:
+            update.append(('market_fees', db.func.if_(
+                Product.price.op('<=>')(insert.inserted.price), Product.market_fees, None
+            )))
+
+        update.extend((f, insert.inserted[f]) for f in fields if f not in ('vendor_id', 'sku', 'extra'))
+        update.append(('extra', db.func.json_merge_patch(db.func.coalesce(Product.extra, '{}'), insert.inserted.extra)))
+        update.append(('last_modified', db.func.now()))
+
+        db.session.execute(insert.on_duplicate_key_update(update), batch)
+
+    db.session.commit()
+
+    product_ids = dict(
+        ((vendor_id, sku), product_id) for product_id, vendor_id, sku in db.session.query(
+            Product.id, Product.vendor_id, Product.sku
+        ).filter(keys.in_(list(rows))).all()
+    )
+
+    guess = [
+        product_ids[key] for key, row in rows.items() if key in product_ids and (
+            key not in existing
+            or ('title' in row and row['title'] != existing[key].title)
+            or ('quantity_desc' in row and row['quantity_desc'] != existing[key].quantity_desc)
+        )
+    ]
+
+    priority = self.get_priority()
+    group(find_amazon_matches.si(i).set(priority=priority) for i in product_ids.values()).apply_async()
+    if guess:
+        group(guess_quantity.si(i).set(priority=priority) for i in guess).apply_async()
+
+
+def vendor_domains():
+    """Return a dictionary of vendor ids keyed by the domain of their website, without 'www.'."""
+    domains = {}
+    for vendor_id, website in db.session.query(Vendor.id, Vendor.website).filter(Vendor.website.isnot(None)).all():
+        domain = normalize_domain(urlparse(website)[1] or website)
+        domains.setdefault(domain, vendor_id)
+
+    return domains
+
+
+def normalize_domain(host):
+    """Return :host: in lower case, without a port, a trailing dot, or a leading 'www.'."""
+    host = host.strip().lower().split('@')[-1].split(':')[0].rstrip('.')
+    return host[4:] if host.startswith('www.') else host
+
+
+def vendor_for_url(url, domains):
+    """Return the id of the vendor whose website hosts :url:, using the result of vendor_domains(). Subdomains match
+    their parent domain's vendor unless they have one of their own, so shop.example.com falls back to example.com.
+    Returns None if no vendor matches."""
+    if not url:
+        return None
+
+    labels = normalize_domain(urlparse(url)[1]).split('.')
+    for i in range(len(labels) - 1):
+        vendor_id = domains.get('.'.join(labels[i:]))
+        if vendor_id is not None:
+            return vendor_id
+
+    return None
+
+
 ########################################################################################################################
 
 
@@ -193,6 +316,15 @@ def update_amazon_listing(self, data, product_id):
     if product is None:
         raise ValueError(f'Invalid product id: {product_id}')
 
+    apply_listing_data(product, data)
+    db.session.commit()
+
+    return product.id
+
+
+def apply_listing_data(product, data):
+    """Update :product: using a parsed API response, a raw update, or a list of either. Does not commit."""
+
     # Separate the data sources into API call results and raw updates
     if not isinstance(data, collections.Sequence):
         data = [data]
@@ -238,10 +370,6 @@ def update_amazon_listing(self, data, product_id):
     for raw_data in raw_updates:
         product.update(raw_data)
 
-    db.session.commit()
-
-    return product.id
-
 
 @celery_app.task(bind=True, base=OpsTask)
 def update_fba_fees(self, product_id, **kwargs):
@@ -260,6 +388,138 @@ def update_fba_fees(self, product_id, **kwargs):
     return product_id
 
 
+@celery_app.task(bind=True, base=OpsTask, **OpsTask.options)
+def update_fba_fees_bulk(self, product_ids, **kwargs):
+    """Updates market_fees for a set of products, requesting fee estimates for up to 20 products per API call. More
+    than 20 products are split into a group of tasks, one per API call, so a failed call only retries its own batch."""
+    kwargs.pop('priority', None)
+    market_id = kwargs.pop('MarketplaceId', 'US')
+    market_id = market_id if len(market_id) > 2 else MARKETID.get(market_id)
+
+    products = Product.query.filter(
+        Product.id.in_(product_ids),
+        Product.price.isnot(None)
+    ).all()
+
+    if not products:
+        return []
+    elif len(products) > 20:
+        ids = [p.id for p in products]
+        group(
+            update_fba_fees_bulk.si(ids[i:i + 20], MarketplaceId=market_id, **kwargs).set(priority=self.get_priority())
+            for i in range(0, len(ids), 20)
+        ).apply_async()
+        return ids
+
+    response = GetMyFeesEstimate(
+        FeesEstimateRequestList=[
+            fees_estimate_request(p.sku, str(p.price), identifier=f'request{n}', market_id=market_id)
+            for n, p in enumerate(products, 1)
+        ],
+        priority=self.get_priority(),
+        **kwargs
+    )
+
+    for product in products:
+        try:
+            product.market_fees = response['results'][product.sku]['total_fees_estimate']
+        except KeyError:
+            logger.debug(f'GetMyFeesEstimate does not contain results for {product.sku}, ignoring...')
+
+    db.session.commit()
+    return [p.id for p in products]
+
+
+async def refresh_amazon_listings(products, priority=0, concurrency=20):
+    """Refresh pricing, listing data and fees for a list of (product id, ASIN) pairs from a single coroutine pool, and
+    write the results to the database as each batch of 20 products comes back.
+
+    The coroutines only make API calls. All database work runs on a single thread, off the event loop, with each write
+    in its own app context and session, so a failed batch can't roll back another batch's changes."""
+    # Imported here so the aiohttp dependency is only needed by workers that run the bulk refresh
+    from tasks.mws.aio import AsyncMWSClient
+
+    market_id = MARKETID.get('US')
+    loop = asyncio.get_running_loop()
+    db_thread = ThreadPoolExecutor(max_workers=1)
+
+    def run_in_db_thread(func, *args):
+        def run():
+            with app.app_context():
+                return func(*args)
+
+        return loop.run_in_executor(db_thread, run)
+
+    def save_listings(ids, data):
+        """Apply listing data to a batch, and return the (id, ASIN, price) of each product that has a price."""
+        batch_products = Product.query.filter(Product.id.in_(ids)).all()
+        for product in batch_products:
+            apply_listing_data(product, data)
+        db.session.commit()
+
+        return [(p.id, p.sku, str(p.price)) for p in batch_products if p.price is not None]
+
+    def save_fees(ids, fees):
+        """Apply fee estimates to a batch, and store each product's history."""
+        batch_products = Product.query.filter(Product.id.in_(ids)).all()
+        for product in batch_products:
+            if fees is not None:
+                apply_listing_data(product, fees)
+            db.session.add(ProductHistory(product))
+        db.session.commit()
+
+    async def refresh_batch(client, batch):
+        ids, asins = [p[0] for p in batch], [p[1] for p in batch]
+        item_ids = [','.join(asins[i:i + 10]) for i in range(0, len(asins), 10)]
+
+        bodies = await asyncio.gather(
+            client.call(mws_products.GetCompetitivePricingForASIN, MarketplaceId=market_id, ASINList=asins),
+            *(
+                client.call(
+                    mws_product_adv.ItemLookup,
+                    ResponseGroup='Images,ItemAttributes,OfferFull,SalesRank,EditorialReview',
+                    ItemId=item_id
+                ) for item_id in item_ids
+            )
+        )
+
+        pricing = AmzXmlResponse(bodies[0])
+        data = [format_parsed_response('GetCompetitivePricingForASIN', {}, *parse_competitive_pricing(pricing))]
+        for body, item_id in zip(bodies[1:], item_ids):
+            data.append(format_parsed_response('ItemLookup', {}, *parse_item_lookup(AmzXmlResponse(body), item_id)))
+
+        priced = await run_in_db_thread(save_listings, ids, data)
+
+        fees = None
+        if priced:
+            fees = AmzXmlResponse(
+                await client.call(
+                    mws_products.GetMyFeesEstimate,
+                    FeesEstimateRequestList=[
+                        fees_estimate_request(sku, price, identifier=f'request{n}', market_id=market_id)
+                        for n, (_, sku, price) in enumerate(priced, 1)
+                    ]
+                )
+            )
+            fees = format_parsed_response('GetMyFeesEstimate', {}, *parse_fees_estimate(fees))
+
+        await run_in_db_thread(save_fees, ids, fees)
+
+    try:
+        async with AsyncMWSClient(concurrency=concurrency, priority=priority) as client:
+            batches = [products[i:i + 20] for i in range(0, len(products), 20)]
+            results = await asyncio.gather(
+                *(refresh_batch(client, batch) for batch in batches),
+                return_exceptions=True
+            )
+    finally:
+        db_thread.shutdown(wait=True)
+
+    for batch, result in zip(batches, results):
+        if isinstance(result, Exception):
+            logger.error(f'Could not refresh products {[p[0] for p in batch]}: {result!r}')
+
+
 @celery_app.task(bind=True, base=OpsTask)
 def store_product_history(self, product_id):
     """Stores a product's current state in the ProductHistory table."""
@@ -275,18 +535,8 @@ def store_product_history(self, product_id):
 @celery_app.task(bind=True, base=OpsTask, ignore_result=True)
 def get_inventory(self):
     """Retrieve inventory from Amazon."""
-    lines = FBAManageInventoryReportLine.query.filter(
-        FBAManageInventoryReportLine.report_id == db.select([
-            AmzReport.id
-        ]).where(
-            db.and_(
-                AmzReport.type == FBAManageInventoryReportLine.report_type,
-                AmzReport.status == '_DONE_'
-            )
-        ).order_by(
-            AmzReport.start_date.desc()
-        ).limit(1)
-    ).all()
+    report = AmzReport.latest(FBAManageInventoryReportLine.report_type)
+    lines = FBAManageInventoryReportLine.snapshot(report) if report else []
 
     for line in lines:
         if line.product is None:
@@ -1,82 +1,206 @@
+import json
+import uuid
+import collections
+from datetime import datetime
+from celery import group, signature
+from celery.utils.log import get_task_logger
+
 from app import db
 from app.models import AmzReport, AmzReportLineMixin
 
-from tasks.parsed.reports import RequestReport, GetReportRequestList, GetReport
+from tasks.parsed.common import PageError
+from tasks.parsed.reports import RequestReport, iter_report_request_list, iter_report
 
 from .common import *
 
+logger = get_task_logger(__name__)
+
 
 ########################################################################################################################
 
 
 @celery_app.task(bind=True, base=OpsTask, **OpsTask.options)
-def update_reports(self, **args):
-    """Submits new reports, updates information on pending reports, and downloads completed reports."""
+def update_reports(self, *args):
+    """Submits new reports, updates information on pending reports, and downloads completed reports. Each step is a
+    single transaction over every report in that state; downloads run as a group of download_reports() tasks, one per
+    report type."""
     if args:
         reports = AmzReport.query.filter(AmzReport.id.in_(args)).all()
         if len(reports) != len(args):
-            ids = (r.id for r in reports)
+            ids = {r.id for r in reports}
             raise ValueError(f"Invalid report id(s): {', '.join(str(i) for i in args if i not in ids)}")
     else:
         reports = AmzReport.query.filter_by(complete=False).all()
 
-    submit = [r for r in reports if r.status is None]
-    pending = [r for r in reports if r.status in ('_SUBMITTED_', '_IN_PROGRESS_')]
-
-    # Submit new reports
-    for report in submit:
-        response = RequestReport(
-            report.type,
-            start=report.start_date,
-            end=report.end_date,
-            **report.options
-        )
-
-        if response['succeeded']:
-            report.update(response['results'])
-        else:
-            report.status = '_CANCELLED_'
+    # Submit new reports. Commit the ones that were submitted even if a later request fails, so they aren't submitted
+    # twice.
+    try:
+        for report in (r for r in reports if r.status is None):
+            response = RequestReport(
+                report.type,
+                start=report.start_date,
+                end=report.end_date,
+                **report.options
+            )
 
+            if response['succeeded']:
+                report.update(response['results'])
+            else:
+                report.status = '_CANCELLED_'
+    finally:
         db.session.commit()
 
-    # Update pending reports
+    # Update pending reports. If a page fails, keep the updates from the pages before it and finish the rest of the
+    # pass, then retry.
+    error = None
+    pending = {r.request_id: r for r in reports if r.status in ('_SUBMITTED_', '_IN_PROGRESS_')}
     if pending:
-        response = GetReportRequestList([r.request_id for r in pending])
-        if response['succeeded']:
-            for result in response['results']:
-                report = [r for r in pending if r.request_id == result['request_id']][0]
-                report.update(result)
-
-        db.session.commit()
-
-    # Download completed reports
-    download = [r for r in reports if r.status == '_DONE_']
-    for report in download:
-        report_data = GetReport(report.report_id, report.type)['results']
         try:
-            line_type = [sc for sc in AmzReportLineMixin.__subclasses__() if sc.report_type == report.type][0]
-        except IndexError:
-            raise ValueError(f'No line item class exists for report type {report.type}')
-
-        for line_data in report_data:
-            line_item = line_type(report_id=report.id)
-            line_item.update(**line_data)
-            db.session.add(line_item)
+            for page in iter_report_request_list(
+                    ReportRequestIdList=list(pending),
+                    priority=self.get_priority()
+            ):
+                for result in page:
+                    if result['request_id'] in pending:
+                        pending[result['request_id']].update(result)
+        except PageError as e:
+            logger.error(f'GetReportRequestList failed: {e.response.error_as_json()}')
+            error = e
 
         db.session.commit()
 
-    # Mark reports as complete
-    complete = [r for r in reports if r.status in ('_CANCELLED_', '_DONE_', '_DONE_NO_DATA_')]
-    for report in complete:
+    # Mark reports with nothing to download as complete
+    for report in (r for r in reports if r.status in ('_CANCELLED_', '_DONE_NO_DATA_')):
         report.complete = True
 
     db.session.commit()
 
+    # Download completed reports. Types that already have a download queued or running are left for a later pass, so
+    # the same reports aren't queued over and over while a big download is in progress.
+    download = collections.defaultdict(list)
+    for report in (r for r in reports if r.status == '_DONE_' and not r.complete):
+        download[report.type].append(report.id)
+
+    for report_type in list(download):
+        lock_key = download_lock_key(report_type)
+        if self.redis.exists(lock_key) or not self.redis.set(lock_key + '_queued', 1, nx=True, ex=600):
+            logger.info(f'{report_type} reports are already being downloaded, skipping: {download.pop(report_type)}')
+
+    if download:
+        group(
+            download_reports.si(*report_ids).set(priority=self.get_priority()) for report_ids in download.values()
+        ).apply_async()
+
+    if error is not None:
+        raise self.retry(exc=error)
+
+
+@celery_app.task(bind=True, base=OpsTask, **OpsTask.options)
+def download_reports(self, *report_ids, lock_timeout=3600, lock_retry=60):
+    """Download and store completed reports, which must all be of the same type. Reports are stored in order, as
+    differences from the one before if the line class has a diff_key (see AmzReportLineMixin), so only one worker
+    downloads each report type at a time. If another worker holds the lock, the task is sent again after :lock_retry:
+    seconds."""
+    reports = AmzReport.query.filter(AmzReport.id.in_(report_ids)).all()
+    if not reports:
+        return
+
+    report_type = reports[0].type
+    if any(r.type != report_type for r in reports):
+        raise ValueError(f'Reports must be of a single type: {report_ids}')
+
+    lock = self.redis.lock(download_lock_key(report_type), timeout=lock_timeout)
+    if not lock.acquire(blocking=False):
+        logger.info(f'Another worker is downloading {report_type} reports, retrying in {lock_retry}s: {report_ids}')
+        self.apply_async(
+            args=report_ids,
+            kwargs={'lock_timeout': lock_timeout, 'lock_retry': lock_retry},
+            countdown=lock_retry,
+            priority=self.get_priority()
+        )
+        return
+
+    self.redis.delete(download_lock_key(report_type) + '_queued')
+
+    try:
+        line_type = AmzReportLineMixin.for_report_type(report_type)
+        for report in sorted(reports, key=lambda r: r.start_date or datetime.min):
+            db.session.refresh(report)
+            if report.complete:
+                continue
+
+            lines = iter_report(report.report_id, report.type, priority=self.get_priority())
+
+            previous = None
+            if line_type.diff_key is not None:
+                base = AmzReport.latest(report.type)
+                if base is not None and len(base.chain()) <= line_type.diff_limit:
+                    report.diff_base_id = base.id
+                    columns = [c for c in line_type.field_names() if c not in ('id', 'report_id')]
+                    previous = {
+                        line_type.line_key(line): {c: getattr(line, c) for c in columns}
+                        for line in line_type.snapshot(base)
+                    }
+
+            insert_report_lines(line_type, report.id, lines, previous=previous)
+            report.complete = True
+            db.session.commit()
+
+            # Resume any chains that were waiting on this report
+            wake_waiters(self.redis)
+    finally:
+        lock.release()
+
+
+def download_lock_key(report_type):
+    """Return the key of the lock held while :report_type: reports are being downloaded."""
+    return f'{download_reports.name}_{report_type}'
+
+
+def insert_report_lines(line_type, report_id, lines, previous=None, chunk_size=1000):
+    """Insert report lines (dictionaries, as parsed by tasks.parsed.reports) into :line_type:'s table, in chunks of
+    :chunk_size: rows per INSERT. Values without a column go into the line's 'extra' column, like UpdateMixin.update()
+    does. If :previous: is given, only the lines that changed since then are inserted (see AmzReportLineMixin.diff())."""
+    columns = {c for c in line_type.field_names() if c not in ('id', 'report_id', 'extra', 'removed')}
+    insert = line_type.__table__.insert()
+    chunk = []
+
+    rows = (
+        {
+            'extra': {k: v for k, v in line.items() if k not in columns},
+            'removed': False,
+            **{c: line.get(c) for c in columns}
+        } for line in lines
+    )
+
+    if previous is not None:
+        rows = line_type.diff(rows, previous)
+
+    for row in rows:
+        chunk.append({**row, 'report_id': report_id})
+
+        if len(chunk) >= chunk_size:
+            db.session.execute(insert, chunk)
+            chunk = []
+
+    if chunk:
+        db.session.execute(insert, chunk)
+
+
+########################################################################################################################
+
+
+# Chains waiting on reports are parked in this redis hash, keyed by a random id. Each value is a JSON object with the
+# ids of the reports and the rest of the chain (the waiting task's request.chain).
+WAITERS_KEY = 'tasks.ops.reports.await_reports_waiters'
+
 
 @celery_app.task(bind=True, base=OpsTask, **OpsTask.options)
 def await_reports(self, *args, interval=60):
-    """Call update_reports() and get_reports() at periodic intervals, retrying until all reports have been
-    downloaded."""
+    """Hold the rest of the chain until all of the given reports have been downloaded. Instead of retrying until
+    they're done, the rest of the chain is parked in redis and this task returns; poll_reports() checks on every
+    pending report once per :interval: seconds, and the chain is resumed as soon as the last of its reports is
+    stored."""
     reports = AmzReport.query.filter(AmzReport.id.in_(args)).all()
     if len(reports) != len(args):
         ids = [r.id for r in reports]
@@ -86,7 +210,82 @@ def await_reports(self, *args, interval=60):
     if failed:
         raise ValueError(f'Reports failed: {failed}')
 
-    pending = [r for r in reports if not r.complete]
-    if pending:
-        update_reports.delay()
-        self.retry(countdown=interval)
\ No newline at end of file
+    pending = [r.id for r in reports if not r.complete]
+    if not pending:
+        return
+
+    if self.request.chain:
+        waiter = json.dumps({'reports': pending, 'chain': self.request.chain})
+        self.redis.hset(WAITERS_KEY, uuid.uuid4().hex, waiter)
+        self.request.chain = None
+
+    schedule_poll(self.redis, interval)
+
+    # The reports might have been stored while the waiter was being parked
+    wake_waiters(self.redis)
+
+
+@celery_app.task(bind=True, base=OpsTask, **OpsTask.options)
+def poll_reports(self, interval=60):
+    """Bring every incomplete report up to date with a single update_reports() pass, and resume any waiting chains
+    whose reports are done. Repeats every :interval: seconds while there are incomplete reports or waiting chains.
+
+    Only one poller runs at a time, no matter how many chains are waiting; use schedule_poll() to start it. Celery beat
+    also runs it every few minutes (see CELERYBEAT_SCHEDULE in config.py), in case a scheduled pass is lost."""
+    lock = self.redis.lock(f'{self.name}_running', timeout=interval * 10)
+    if not lock.acquire(blocking=False):
+        schedule_poll(self.redis, interval, force=True)
+        return
+
+    try:
+        # Anything that asks for a poll from now on needs another pass
+        self.redis.delete(f'{self.name}_scheduled')
+
+        update_reports()
+        wake_waiters(self.redis)
+    finally:
+        # Schedule the next pass even if this one failed, so waiting chains don't get stuck
+        try:
+            db.session.rollback()
+            if self.redis.hlen(WAITERS_KEY) or AmzReport.query.filter_by(complete=False).count():
+                schedule_poll(self.redis, interval)
+        finally:
+            lock.release()
+
+
+def schedule_poll(redis_client, countdown, force=False):
+    """Schedule a poll_reports() pass in :countdown: seconds, unless one is already scheduled."""
+    scheduled = redis_client.set(f'{poll_reports.name}_scheduled', 1, nx=not force, ex=int(countdown) * 2 + 60)
+    if scheduled:
+        poll_reports.apply_async(kwargs={'interval': countdown}, countdown=countdown)
+
+
+def wake_waiters(redis_client):
+    """Resume the waiting chains whose reports have all been downloaded. Chains waiting on a cancelled report are
+    dropped. Safe to call from any number of workers at once: each chain is resumed by whoever removes it first."""
+    waiters = {k: json.loads(v) for k, v in redis_client.hgetall(WAITERS_KEY).items()}
+    if not waiters:
+        return
+
+    # Start a new transaction, to see reports stored by other workers
+    db.session.commit()
+
+    report_ids = {i for waiter in waiters.values() for i in waiter['reports']}
+    reports = {r.id: r for r in AmzReport.query.filter(AmzReport.id.in_(report_ids)).all()}
+
+    for key, waiter in waiters.items():
+        waiting_on = [reports.get(i) for i in waiter['reports']]
+        failed = [r for r in waiting_on if r is None or r.status == '_CANCELLED_']
+
+        if not failed and not all(r.complete for r in waiting_on):
+            continue
+
+        if not redis_client.hdel(WAITERS_KEY, key):
+            continue
+
+        if failed:
+            logger.warning(f'Dropped a chain waiting on failed reports: {waiter["reports"]}')
+            continue
+
+        chain = waiter['chain']
+        signature(chain.pop(), app=celery_app).apply_async((None,), chain=chain or None)
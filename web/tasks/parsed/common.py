@@ -1,5 +1,13 @@
 import re
+import io
+import os
+import json
+import redis
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import unescape
 from lxml import etree
+from flask import current_app, has_app_context
 
 from app import celery_app
 
@@ -23,12 +31,154 @@ def format_parsed_response(action, params, results=None, errors=None, succeeded=
 ########################################################################################################################
 
 
+coalescer_redis = redis.from_url(os.environ.get('CELERY_REDIS_URL', 'redis://'))
+
+
+class BatchError(Exception):
+    """Raised by a RequestCoalescer's fetch function when the batch request as a whole is an error response."""
+
+    def __init__(self, response):
+        super().__init__(f'{response.error_code}: {response.error_message}')
+        self.response = response
+
+
+class RequestCoalescer:
+    """Collects single-item requests from concurrent tasks and sends them to the API in batches, without blocking a
+    worker while the batch fills up.
+
+    A task calls submit() with its item. If a recent batch already fetched the item, its result is returned straight
+    away. Otherwise the item is queued, a flush task is scheduled to run after :window: seconds, and the task retries
+    itself to pick up the result. The flush task calls flush(), which takes up to :batch_size: queued items, fetches
+    them in one call, and stores each item's result for :result_ttl: seconds, or :error_ttl: seconds for cacheable
+    errors. Items the batch had no cacheable answer for are handed back to their tasks, which make the call by
+    themselves.
+
+    Items are queued separately for each :scope: (e.g. a marketplace) and priority, so a batch is only ever made at
+    the priority of the tasks waiting on it. Results are shared across priorities. An item that is already queued or
+    in flight is not queued again."""
+
+    # Move up to ARGV[1] items from the queue to the in-flight set, and return them
+    # Call like so: EVALSHA sha 2 queue_key inflight_key count
+    take_script = """
+    local items = redis.call('SPOP', KEYS[1], ARGV[1])
+    if #items > 0 then
+        redis.call('SADD', KEYS[2], unpack(items))
+    end
+    return items
+    """
+
+    def __init__(self, name, batch_size=20, window=1.0, timeout=60, result_ttl=300, error_ttl=None):
+        self.redis = coalescer_redis
+        self._take = self.redis.register_script(self.take_script)
+        self.name = name
+        self.batch_size = batch_size
+        self.window = window
+        self.timeout = timeout
+        self.result_ttl = result_ttl
+        self.error_ttl = error_ttl
+
+    def queue_key(self, scope, priority):
+        return f'{self.name}_coalesce_{scope}_{priority}'
+
+    def result_key(self, scope, item):
+        return f'{self.name}_coalesce_result_{scope}_{item}'
+
+    def submit(self, task, scope, item, flush):
+        """Return the result for :item:, or queue it for the next batch and retry :task: (the running task) until the
+        result is in. :flush: is the signature of a task that calls flush() for :scope: at the task's priority.
+
+        Returns None if the task was called directly, if the batch had no cacheable answer for the item, or if no batch
+        delivered the result within :timeout:. The caller should make the call by itself in that case."""
+        result = self.redis.get(self.result_key(scope, item))
+        if result is not None:
+            return json.loads(result)
+
+        if task.request.called_directly:
+            return None
+
+        priority = task.get_priority()
+        queue_key = self.queue_key(scope, priority)
+        inflight_key = queue_key + '_inflight'
+        waits = int(self.timeout / self.window)
+
+        if task.request.retries >= waits:
+            # Only give up if no batch has taken the item, so it isn't requested twice
+            if self.redis.srem(queue_key, item) or not self.redis.sismember(inflight_key, item) \
+                    or task.request.retries >= waits * 2:
+                return None
+        elif not self.redis.sismember(inflight_key, item):
+            pipe = self.redis.pipeline()
+            pipe.sadd(queue_key, item)
+            pipe.scard(queue_key)
+            pipe.set(queue_key + '_scheduled', 1, nx=True, ex=max(int(self.window * 2), 1))
+            _, queued, schedule = pipe.execute()
+
+            if queued >= self.batch_size:
+                flush.apply_async(priority=priority)
+            elif schedule:
+                flush.apply_async(countdown=self.window, priority=priority)
+
+        raise task.retry(countdown=self.window, max_retries=waits * 2 + 1)
+
+    def flush(self, scope, priority, fetch):
+        """Fetch a batch of queued items with fetch(), and store the results. fetch() is called with a list of items and
+        must return two dictionaries of JSON-serializable values keyed by item: the results, and the errors that can be
+        cached. Items in neither are handed back to their tasks. Returns the number of items still queued.
+
+        If fetch() raises (e.g. BatchError, when the whole request failed), the batch is put back in the queue, and the
+        waiting tasks schedule another flush."""
+        queue_key = self.queue_key(scope, priority)
+        inflight_key = queue_key + '_inflight'
+
+        # Anything queued from now on needs another flush
+        self.redis.delete(queue_key + '_scheduled')
+
+        items = [item.decode() for item in self._take(keys=[queue_key, inflight_key], args=[self.batch_size])]
+        if not items:
+            return 0
+
+        try:
+            results, errors = fetch(items)
+        except Exception:
+            pipe = self.redis.pipeline()
+            pipe.sadd(queue_key, *items)
+            pipe.srem(inflight_key, *items)
+            pipe.execute()
+            raise
+
+        pipe = self.redis.pipeline()
+        for item in items:
+            if item in results:
+                pipe.set(self.result_key(scope, item), json.dumps(results[item]), ex=self.result_ttl)
+            elif item in errors and self.error_ttl:
+                pipe.set(self.result_key(scope, item), json.dumps(errors[item]), ex=self.error_ttl)
+            else:
+                # A null result sends the waiting task back to making the call by itself
+                pipe.set(self.result_key(scope, item), json.dumps(None), ex=max(int(self.timeout), 1))
+        pipe.srem(inflight_key, *items)
+        pipe.scard(queue_key)
+        return pipe.execute()[-1]
+
+
+########################################################################################################################
+
+
+ns_decl_re = re.compile(rb' xmlns(:\w*)?="[^"]*"', re.IGNORECASE)
+ns_open_re = re.compile(rb'<\w+:')
+ns_close_re = re.compile(rb'/\w+:')
+error_response_re = re.compile(rb'<ErrorResponse[\s>]')
+
+
 class AmzXmlResponse:
-    """A utility class for dealing with Amazon's XML responses."""
+    """A utility class for dealing with Amazon's XML responses.
+
+    By default the whole response is parsed into self.tree. With stream=True, the tree is only built for error
+    responses, and the caller reads the response with iter_elements(), which parses it incrementally."""
 
-    def __init__(self, xml=None):
+    def __init__(self, xml=None, stream=False):
         self._xml = None
         self.tree = None
+        self.stream = stream
 
         self.xml = xml
 
@@ -43,20 +193,37 @@ class AmzXmlResponse:
 
         if xml is not None:
             self._xml = self.remove_namespaces(xml)
-            self.tree = etree.fromstring(self._xml)
+            if not self.stream or error_response_re.search(self._xml, 0, 4096):
+                self.tree = etree.fromstring(self._xml)
 
     @staticmethod
     def remove_namespaces(xml):
-        """Remove all traces of namespaces from the given XML string."""
-        re_ns_decl = re.compile(r' xmlns(:\w*)?="[^"]*"', re.IGNORECASE)
-        re_ns_open = re.compile(r'<\w+:')
-        re_ns_close = re.compile(r'/\w+:')
-
-        response = re_ns_decl.sub('', xml)  # Remove namespace declarations
-        response = re_ns_open.sub('<', response)  # Remove namespaces in opening tags
-        response = re_ns_close.sub('/', response)  # Remove namespaces in closing tags
+        """Remove all traces of namespaces from the given XML, and return it as bytes."""
+        response = xml.encode() if isinstance(xml, str) else xml
+        response = ns_decl_re.sub(b'', response)  # Remove namespace declarations
+        response = ns_open_re.sub(b'<', response)  # Remove namespaces in opening tags
+        response = ns_close_re.sub(b'/', response)  # Remove namespaces in closing tags
         return response
 
+    def iter_elements(self, *tags):
+        """Yield each element in the response with one of the given tags, in document order. In stream mode, elements
+        are yielded as soon as they have been parsed, and are cleared (along with the siblings before them) once the
+        caller moves on, so memory use stays flat no matter how big the response is. Elements that come after the
+        yielded element, including its parent's later children, are not available yet."""
+        if self.tree is not None:
+            yield from self.tree.iter(*tags)
+            return
+
+        if self._xml is None:
+            return
+
+        for _, element in etree.iterparse(io.BytesIO(self._xml), events=('end',), tag=tags):
+            yield element
+
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
     def xpath_get(self, path, root_tag=None, _type=str, default=None):
         """Utility method for getting data values from XPath selectors."""
         tag = root_tag if root_tag is not None else self.tree
@@ -101,4 +268,157 @@ class AmzXmlResponse:
                 'message': self.error_message,
                 'request_id': self.request_id
             }
-        }
\ No newline at end of file
+        }
+
+
+########################################################################################################################
+
+
+path_step_re = re.compile(r'(//?)([\w.-]+)')
+
+
+class Field:
+    """Describes a value to extract from an item element. :paths: are tried in order, and the first one with a value
+    (after casting with :_type:) is used. Paths are simple relative XPaths made of tag names, like './/Brand',
+    './Identifiers/MarketplaceASIN/ASIN' or './/FeesEstimateIdentifier//ListingPrice/Amount'. If :join: is given, the
+    values of every element matching the paths are joined with it instead."""
+
+    def __init__(self, *paths, _type=str, default=None, join=None):
+        self.paths = paths
+        self._type = _type
+        self.default = default
+        self.join = join
+
+    def cast(self, text):
+        """Cast an element's text to the field's type, or return None if it can't be."""
+        try:
+            if self._type is str and text is None:
+                raise TypeError
+            return self._type(text)
+        except (ValueError, TypeError):
+            return None
+
+
+class FieldExtractor:
+    """Extracts a dictionary of fields from item elements, like the Product tags in a ListMatchingProducts response.
+    All the fields' paths are compiled into a single XPath, so each item is searched once, and every element found is
+    matched back to the fields it belongs to.
+
+        extract = FieldExtractor(
+            brand=Field('.//Brand', './/Manufacturer'),
+            price=Field('.//ListPrice/Amount', _type=float)
+        )
+        product = extract(product_tag)
+    """
+
+    def __init__(self, **fields):
+        self.fields = fields
+        self._matchers = collections.defaultdict(list)
+
+        for name, field in fields.items():
+            for rank, path in enumerate(field.paths):
+                steps = path_step_re.findall(path)
+                self._matchers[steps[-1][1]].append((steps, name, rank))
+
+        self._xpath = etree.XPath(' | '.join({path for field in fields.values() for path in field.paths}))
+
+    def __call__(self, element):
+        """Return a dictionary of the fields found in :element:. Fields without a value are set to their default."""
+        values, ranks, joined = {}, {}, collections.defaultdict(list)
+
+        for node in self._xpath(element):
+            for steps, name, rank in self._matchers[node.tag]:
+                field = self.fields[name]
+                if field.join is None and ranks.get(name, rank + 1) <= rank:
+                    continue
+                if not self.match(node, steps, len(steps) - 1, element):
+                    continue
+
+                value = field.cast(node.text)
+                if value is None:
+                    continue
+                elif field.join is not None:
+                    joined[name].append(value)
+                else:
+                    values[name], ranks[name] = value, rank
+
+        for name, parts in joined.items():
+            values[name] = self.fields[name].join.join(parts)
+
+        return {name: values.get(name, field.default) for name, field in self.fields.items()}
+
+    def match(self, node, steps, index, root):
+        """Return True if :node: is selected by steps[:index + 1] of a path, relative to :root:."""
+        separator, tag = steps[index]
+        if node is None or node is root or node.tag != tag:
+            return False
+
+        parent = node.getparent()
+        if index == 0:
+            return parent is root or separator == '//'
+        elif separator == '/':
+            return self.match(parent, steps, index - 1, root)
+
+        while parent is not None and parent is not root:
+            if self.match(parent, steps, index - 1, root):
+                return True
+            parent = parent.getparent()
+
+        return False
+
+
+########################################################################################################################
+
+
+next_token_re = re.compile(r'<(?:\w+:)?NextToken>([^<]+)</(?:\w+:)?NextToken>')
+has_next_false_re = re.compile(r'<(?:\w+:)?HasNext>\s*false\s*</')
+
+
+class PageError(Exception):
+    """Raised by iter_pages() when a page is an error response."""
+
+    def __init__(self, response):
+        super().__init__(f'{response.error_code}: {response.error_message}')
+        self.response = response
+
+
+def next_page_token(body):
+    """Return the NextToken of a paginated response body, or None if it's the last page. This is a cheap regex search,
+    so the next page can be requested before the current one is parsed."""
+    if has_next_false_re.search(body):
+        return None
+
+    match = next_token_re.search(body)
+    return unescape(match.group(1)).strip() if match else None
+
+
+def iter_pages(first_page, next_page, parse):
+    """Yield the results of a NextToken-paginated operation one page at a time, as the pages arrive. :first_page: is a
+    callable that returns the first response body, :next_page: takes a NextToken and returns the next one, and :parse:
+    takes an AmzXmlResponse (in stream mode) and returns the page's results. The next page is fetched in a background
+    thread while the current one is parsed and consumed. Raises PageError if a page is an error response.
+
+    The fetches run inside an app context for the caller's Flask app, but outside of the caller's task request: tasks
+    called from them are called directly, so they wait out throttling instead of rescheduling, and :first_page: and
+    :next_page: have to pass the priority explicitly."""
+    app = current_app._get_current_object() if has_app_context() else celery_app.app
+
+    def fetch(func, *args):
+        with app.app_context():
+            return func(*args)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(fetch, first_page)
+
+        while future is not None:
+            body = future.result()
+            token = next_page_token(body)
+            future = executor.submit(fetch, next_page, token) if token else None
+
+            response = AmzXmlResponse(body, stream=True)
+            if response.error_code:
+                if future is not None:
+                    future.cancel()
+                raise PageError(response)
+
+            yield parse(response)
@@ -7,6 +7,18 @@ from amazonmws import MARKETID
 ########################################################################################################################
 
 
+# Fields extracted from each member of a ListInventorySupply response's InventorySupplyList
+inventory_supply_fields = FieldExtractor(
+    sku=Field('.//ASIN'),
+    fnsku=Field('.//FNSKU'),
+    in_stock=Field('.//InStockSupplyQuantity', _type=int),
+    msku=Field('.//SellerSKU')
+)
+
+
+########################################################################################################################
+
+
 @celery_app.task(bind=True)
 def ListInventorySupply(self, start=None, **kwargs):
     """Return a dictionary of ASINs in inventory, with some associated data (FNSKUs, etc.)"""
@@ -22,30 +34,30 @@ def ListInventorySupply(self, start=None, **kwargs):
         **kwargs
     }
 
-    response = AmzXmlResponse(
-        inventory.ListInventorySupply(**params, priority=self.get_priority())
+    results = []
+    try:
+        for page in iter_inventory_supply(priority=self.get_priority(), **params):
+            results.extend(page)
+    except PageError as e:
+        return format_parsed_response('ListInventorySupply', params, results, errors=e.response.error_as_json())
+
+    return format_parsed_response('ListInventorySupply', params, results)
+
+
+def iter_inventory_supply(priority=0, **params):
+    """Yield pages of ListInventorySupply results as they arrive, prefetching each next page. See iter_pages()."""
+    return iter_pages(
+        lambda: inventory.ListInventorySupply(**params, priority=priority),
+        lambda token: inventory.ListInventorySupplyByNextToken(token, priority=priority),
+        parse_inventory_supply
     )
 
+
+def parse_inventory_supply(response):
+    """Parse a page of ListInventorySupply results into a list of products."""
     results = []
-    while response:
-        if response.error_code:
-            return format_parsed_response('ListInventorySupply', params, results, errors=response.error_as_json())
-
-        for tag in response.tree.iterdescendants('member'):
-            product = dict()
-            product['sku'] = response.xpath_get('.//ASIN', tag)
-            product['fnsku'] = response.xpath_get('.//FNSKU', tag)
-            product['in_stock'] = response.xpath_get('.//InStockSupplyQuantity', tag, _type=int)
-            product['msku'] = response.xpath_get('.//SellerSKU', tag)
-
-            results.append({k: v for k, v in product.items() if v is not None})
-
-        next_token = response.xpath_get('.//NextToken')
-        if next_token:
-            response = AmzXmlResponse(
-                inventory.ListInventorySupplyByNextToken(next_token, priority=self.get_priority())
-            )
-        else:
-            response = None
+    for tag in response.iter_elements('member'):
+        product = inventory_supply_fields(tag)
+        results.append({k: v for k, v in product.items() if v is not None})
 
-    return format_parsed_response('ListInventorySupply', params, results)
+    return results
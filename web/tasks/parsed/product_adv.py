@@ -6,6 +6,29 @@ from amazonmws import MARKETID
 ########################################################################################################################
 
 
+# Fields extracted from each Item in an ItemLookup response
+item_fields = FieldExtractor(
+    sku=Field('.//ASIN'),
+    rank=Field('.//SalesRank', _type=int),
+    category=Field('.//ProductGroup'),
+    image_url=Field('.//LargeImage/URL'),
+    brand=Field('.//Brand', './/Manufacturer', './/Label', './/Publisher', './/Studio', './/Model'),
+    model=Field('.//Model', './/MPN', './/PartNumber'),
+    NumberOfItems=Field('.//NumberOfItems', _type=int),
+    PackageQuantity=Field('.//PackageQuantity', _type=int),
+    title=Field('.//Title'),
+    upc=Field('.//UPC'),
+    merchant=Field('.//Merchant'),
+    prime=Field('.//IsEligibleForPrime'),
+    features=Field('.//Feature', join='\n'),
+    description=Field('.//EditorialReview/Content'),
+    price=Field('.//LowestNewPrice/Amount', _type=float)
+)
+
+
+########################################################################################################################
+
+
 @celery_app.task
 def ItemSearch(SearchIndex, **kwargs):
     raise NotImplementedError
@@ -18,7 +41,10 @@ def BrowseNodeLookup(BrowseNodeId, ResponseGroup=None):
 
 @celery_app.task(bind=True)
 def ItemLookup(self, asin=None, **kwargs):
+    """Perform an ItemLookup request. Single-ASIN lookups are coalesced with other pending lookups into requests of up
+    to 10 ASINs."""
     kwargs.pop('priority', None)
+    coalesce = kwargs.pop('coalesce', True)
 
     params = {
         'ResponseGroup': 'Images,ItemAttributes,OfferFull,SalesRank,EditorialReview',
@@ -26,53 +52,91 @@ def ItemLookup(self, asin=None, **kwargs):
         **kwargs
     }
 
+    if coalesce and asin is not None and not kwargs:
+        result = item_batches.submit(self, 'US', asin, flush_item_lookup.si())
+        if result is not None:
+            return result
+
     response = AmzXmlResponse(
         product_adv.ItemLookup(**params, priority=self.get_priority())
     )
 
+    results, errors = parse_item_lookup(response, params['ItemId'])
+    return format_parsed_response('ItemLookup', params, results, errors)
+
+
+# Single-ASIN lookups waiting to be sent in a batch. Results are kept as long as the cached ItemLookup responses, and
+# cacheable errors as long as ItemLookup caches them.
+item_batches = RequestCoalescer(
+    'ItemLookup',
+    batch_size=10,
+    result_ttl=product_adv.ItemLookup.cache_ttl,
+    error_ttl=product_adv.ItemLookup.error_cache_ttl
+)
+
+
+@celery_app.task(bind=True)
+def flush_item_lookup(self):
+    """Send a batch of coalesced ItemLookup requests, at this task's priority."""
+    priority = self.get_priority()
+    queued = item_batches.flush('US', priority, lambda asins: item_lookup_batch(asins, priority=priority))
+
+    if queued:
+        self.apply_async(priority=priority)
+
+
+def item_lookup_batch(asins, priority=0):
+    """Look up a batch of ASINs. Returns two dictionaries of parsed responses, one per ASIN: the ASINs that got a
+    result, and the ones with a cacheable error that names them. Errors that don't name an ASIN aren't given to any of
+    them. Raises BatchError if the whole request failed."""
+    task = product_adv.ItemLookup
+    params = {
+        'ResponseGroup': 'Images,ItemAttributes,OfferFull,SalesRank,EditorialReview',
+        'ItemId': ','.join(asins)
+    }
+
+    response = AmzXmlResponse(task(**params, priority=priority))
+    if response.error_code:
+        raise BatchError(response)
+
+    results, errors = parse_item_lookup(response, params['ItemId'])
+
+    def parsed(asin, results=None, errors=None):
+        return format_parsed_response('ItemLookup', {**params, 'ItemId': asin}, results, errors)
+
+    # Product Advertising error codes look like 'AWS.InvalidParameterValue'
+    return (
+        {asin: parsed(asin, results={asin: results[asin]}) for asin in asins if asin in results},
+        {
+            asin: parsed(asin, errors={asin: errors[asin]}) for asin in asins
+            if asin not in results and asin in errors
+            and errors[asin].split(':')[0].split('.')[-1] in task.cacheable_errors
+        }
+    )
+
+
+def parse_item_lookup(response, item_ids):
+    """Parse an ItemLookup response into dictionaries of results and errors, keyed by ASIN."""
     errors = {}
     for error_tag in response.tree.iterdescendants('Error'):
         code = response.xpath_get('.//Code', error_tag)
         message = code + ': ' + response.xpath_get('.//Message', error_tag)
-        asin = [sku.strip() for sku in params['ItemId'].split(',') if sku.strip().upper() in message]
+        asin = [sku.strip() for sku in item_ids.split(',') if sku.strip().upper() in message]
         if asin:
             errors[asin[0]] = message
         else:
-            errors['other'] = errors.get('other', []).append(message)
+            errors.setdefault('other', []).append(message)
 
     results = {}
     for item_tag in response.tree.iterdescendants('Item'):
-        product = {}
-        product['sku'] = response.xpath_get('.//ASIN', item_tag)
+        product = item_fields(item_tag)
         product['detail_url'] = f'http://www.amazon.com/dp/{product["sku"]}'
-        product['rank'] = response.xpath_get('.//SalesRank', item_tag, _type=int)
-        product['category'] = response.xpath_get('.//ProductGroup', item_tag)
-        product['image_url'] = response.xpath_get('.//LargeImage/URL', item_tag)
-        product['brand'] = response.xpath_get('.//Brand', item_tag)\
-            or response.xpath_get('.//Manufacturer', item_tag)\
-            or response.xpath_get('.//Label', item_tag)\
-            or response.xpath_get('.//Publisher', item_tag)\
-            or response.xpath_get('.//Studio', item_tag)\
-            or response.xpath_get('.//Model', item_tag)
-        product['model'] = response.xpath_get('.//Model', item_tag)\
-            or response.xpath_get('.//MPN', item_tag)\
-            or response.xpath_get('.//PartNumber', item_tag)
-        product['NumberOfItems'] = response.xpath_get('.//NumberOfItems', item_tag, _type=int)
-        product['PackageQuantity'] = response.xpath_get('.//PackageQuantity', item_tag, _type=int)
-        product['title'] = response.xpath_get('.//Title', item_tag)
-        product['upc'] = response.xpath_get('.//UPC', item_tag)
-        product['merchant'] = response.xpath_get('.//Merchant', item_tag)
-        product['prime'] = response.xpath_get('.//IsEligibleForPrime', item_tag)
-        product['features'] = '\n'.join((t.text for t in item_tag.iterdescendants('Feature'))) or None
-        product['description'] = response.xpath_get('.//EditorialReview/Content', item_tag)
-
-        price = response.xpath_get('.//LowestNewPrice/Amount', _type=float)
-        product['price'] = price / 100 if price is not None else None
+        product['price'] = product['price'] / 100 if product['price'] is not None else None
 
         product = {k: v for k, v in product.items() if v is not None}
         results[product['sku']] = product
 
-    return format_parsed_response('ItemLookup', params, results, errors)
+    return results, errors
 
 
 @celery_app.task
@@ -6,6 +6,39 @@ from amazonmws import MARKETID
 ########################################################################################################################
 
 
+# Fields extracted from each Product in a ListMatchingProducts response
+matching_product_fields = FieldExtractor(
+    sku=Field('./Identifiers/MarketplaceASIN/ASIN'),
+    brand=Field('.//Brand', './/Manufacturer', './/Label', './/Publisher', './/Studio'),
+    model=Field('.//Model', './/PartNumber'),
+    price=Field('.//ListPrice/Amount', _type=float),
+    NumberOfItems=Field('.//NumberOfItems', _type=int),
+    PackageQuantity=Field('.//PackageQuantity', _type=int),
+    image_url=Field('.//SmallImage/URL'),
+    title=Field('.//Title'),
+    description=Field('.//Feature', join='\n')
+)
+
+# Fields extracted from each FeesEstimateResult in a GetMyFeesEstimate response
+fees_estimate_fields = FieldExtractor(
+    sku=Field('.//FeesEstimateIdentifier/IdValue'),
+    status=Field('.//Status'),
+    price=Field('.//FeesEstimateIdentifier//ListingPrice/Amount'),
+    total_fees_estimate=Field('.//TotalFeesEstimate/Amount', _type=float),
+    error=Field('.//Error/Message')
+)
+
+# Fields extracted from each CompetitivePrice in a GetCompetitivePricingForASIN response
+competitive_price_fields = FieldExtractor(
+    listing_price=Field('.//ListingPrice/Amount', _type=float),
+    shipping=Field('.//Shipping/Amount', _type=float),
+    landed_price=Field('.//LandedPrice/Amount', _type=float)
+)
+
+
+########################################################################################################################
+
+
 @celery_app.task(bind=True)
 def GetServiceStatus(self, **kwargs):
     kwargs.pop('priority', None)
@@ -34,28 +67,22 @@ def ListMatchingProducts(self, query=None, **kwargs):
     }
 
     response = AmzXmlResponse(
-        products.ListMatchingProducts(**params, priority=self.get_priority())
+        products.ListMatchingProducts(**params, priority=self.get_priority()),
+        stream=True
     )
 
     if response.error_code:
         return format_parsed_response('ListMatchingProducts', params, errors=response.error_as_json())
 
+    results = parse_matching_products(response)
+    return format_parsed_response('ListMatchingProducts', params, results)
+
+
+def parse_matching_products(response):
+    """Parse a ListMatchingProducts response into a list of products."""
     results = []
-    for tag in response.tree.iterdescendants('Product'):
-        product = dict()
-        product['sku'] = response.xpath_get('./Identifiers/MarketplaceASIN/ASIN', tag)
-        product['brand'] = response.xpath_get('.//Brand', tag) \
-                           or response.xpath_get('.//Manufacturer', tag) \
-                           or response.xpath_get('.//Label', tag) \
-                           or response.xpath_get('.//Publisher', tag) \
-                           or response.xpath_get('.//Studio', tag)
-        product['model'] = response.xpath_get('.//Model', tag) \
-                           or response.xpath_get('.//PartNumber', tag)
-        product['price'] = response.xpath_get('.//ListPrice/Amount', tag, _type=float)
-        product['NumberOfItems'] = response.xpath_get('.//NumberOfItems', tag, _type=int)
-        product['PackageQuantity'] = response.xpath_get('.//PackageQuantity', tag, _type=int)
-        product['image_url'] = response.xpath_get('.//SmallImage/URL', tag)
-        product['title'] = response.xpath_get('.//Title', tag)
+    for tag in response.iter_elements('Product'):
+        product = matching_product_fields(tag)
 
         for rank_tag in tag.iterdescendants('SalesRank'):
             if not rank_tag.xpath('./ProductCategoryId')[0].text.isdigit():
@@ -63,34 +90,23 @@ def ListMatchingProducts(self, query=None, **kwargs):
                 product['rank'] = response.xpath_get('./Rank', rank_tag, _type=int)
                 break
 
-        product['description'] = '\n'.join([t.text for t in tag.iterdescendants('Feature')]) or None
-
         results.append({k: v for k, v in product.items() if v is not None})
 
-    return format_parsed_response('ListMatchingProducts', params, results)
+    return results
 
 
 @celery_app.task(bind=True)
 def GetMyFeesEstimate(self, asin=None, price=None, **kwargs):
-    """Return the total fees estimate for a given ASIN and price."""
+    """Return the total fees estimate for a given ASIN and price, or for each entry in FeesEstimateRequestList."""
     kwargs.pop('priority', None)
 
-    # Allow two-letter marketplace abbreviations
     # Allow two-letter abbreviations for MarketplaceId
     market_id = kwargs.pop('MarketplaceId', 'US')
     market_id = market_id if len(market_id) > 2 else MARKETID.get(market_id)
 
     params = {
         'FeesEstimateRequestList': kwargs.pop('FeesEstimateRequestList', None) or [
-            {
-                'MarketplaceId': market_id,
-                'IdType': 'ASIN',
-                'IdValue': asin,
-                'IsAmazonFulfilled': 'true',
-                'Identifier': 'request1',
-                'PriceToEstimateFees.ListingPrice.CurrencyCode': 'USD',
-                'PriceToEstimateFees.ListingPrice.Amount': price
-            }
+            fees_estimate_request(asin, price, market_id=market_id)
         ],
         **kwargs
     }
@@ -102,25 +118,46 @@ def GetMyFeesEstimate(self, asin=None, price=None, **kwargs):
     if response.error_code:
         return format_parsed_response('GetMyFeesEstimate', params, errors=response.error_as_json())
 
+    results, errors = parse_fees_estimate(response, price)
+    return format_parsed_response('GetMyFeesEstimate', params, results, errors)
+
+
+def parse_fees_estimate(response, price=None):
+    """Parse a GetMyFeesEstimate response into dictionaries of results and errors, keyed by ASIN."""
     results, errors = {}, {}
     for result_tag in response.tree.iterdescendants('FeesEstimateResult'):
-        sku = response.xpath_get('.//FeesEstimateIdentifier/IdValue', result_tag)
+        fields = fees_estimate_fields(result_tag)
 
-        if response.xpath_get('.//Status', result_tag) == 'Success':
-            results[sku] = {
-                'price': price,
-                'total_fees_estimate': response.xpath_get('.//TotalFeesEstimate/Amount', _type=float)
+        if fields['status'] == 'Success':
+            results[fields['sku']] = {
+                'price': fields['price'] or price,
+                'total_fees_estimate': fields['total_fees_estimate']
             }
         else:
-            errors[sku] = response.xpath_get('.//Error/Message')
+            errors[fields['sku']] = fields['error']
 
-    return format_parsed_response('GetMyFeesEstimate', params, results, errors)
+    return results, errors
+
+
+def fees_estimate_request(asin, price, identifier='request1', market_id=MARKETID.get('US')):
+    """Build a single entry for GetMyFeesEstimate's FeesEstimateRequestList."""
+    return {
+        'MarketplaceId': market_id,
+        'IdType': 'ASIN',
+        'IdValue': asin,
+        'IsAmazonFulfilled': 'true',
+        'Identifier': identifier,
+        'PriceToEstimateFees.ListingPrice.CurrencyCode': 'USD',
+        'PriceToEstimateFees.ListingPrice.Amount': price
+    }
 
 
 @celery_app.task(bind=True)
 def GetCompetitivePricingForASIN(self, asin=None, **kwargs):
-    """Perform a GetCompetivePricingForASIN call and return the results as a simplified JSON dictionary."""
+    """Perform a GetCompetivePricingForASIN call and return the results as a simplified JSON dictionary. Single-ASIN
+    lookups are coalesced with other pending lookups into calls of up to 20 ASINs."""
     kwargs.pop('priority', None)
+    coalesce = kwargs.pop('coalesce', True)
 
     market_id = kwargs.pop('MarketplaceId', 'US')
     market_id = market_id if len(market_id) > 2 else MARKETID.get(market_id)
@@ -131,10 +168,72 @@ def GetCompetitivePricingForASIN(self, asin=None, **kwargs):
         **kwargs
     }
 
+    if coalesce and asin is not None and len(params) == 2:
+        result = pricing_batches.submit(self, market_id, asin, flush_competitive_pricing.si(market_id))
+        if result is not None:
+            return result
+
     response = AmzXmlResponse(
         products.GetCompetitivePricingForASIN(**params, priority=self.get_priority())
     )
 
+    if response.error_code:
+        return format_parsed_response('GetCompetitivePricingForASIN', params, errors=response.error_as_json())
+
+    results, errors = parse_competitive_pricing(response)
+    return format_parsed_response('GetCompetitivePricingForASIN', params, results, errors)
+
+
+# Single-ASIN lookups waiting to be sent in a batch. Results are kept as long as cached GetCompetitivePricingForASIN
+# responses are fresh, and cacheable errors as long as they are cached.
+pricing_batches = RequestCoalescer(
+    'GetCompetitivePricingForASIN',
+    batch_size=20,
+    result_ttl=products.GetCompetitivePricingForASIN.cache_soft_ttl,
+    error_ttl=products.GetCompetitivePricingForASIN.error_cache_ttl
+)
+
+
+@celery_app.task(bind=True)
+def flush_competitive_pricing(self, market_id):
+    """Send a batch of coalesced GetCompetitivePricingForASIN lookups, at this task's priority."""
+    priority = self.get_priority()
+    queued = pricing_batches.flush(
+        market_id,
+        priority,
+        lambda asins: get_competitive_pricing_batch(market_id, asins, priority=priority)
+    )
+
+    if queued:
+        self.apply_async(args=(market_id,), priority=priority)
+
+
+def get_competitive_pricing_batch(market_id, asins, priority=0):
+    """Get competitive pricing for a batch of ASINs. Returns two dictionaries of parsed responses, one per ASIN: the
+    ASINs that succeeded, and the ones that failed with a cacheable error. Raises BatchError if the whole call failed."""
+    task = products.GetCompetitivePricingForASIN
+    response = AmzXmlResponse(task(MarketplaceId=market_id, ASINList=asins, priority=priority))
+
+    if response.error_code:
+        raise BatchError(response)
+
+    results, errors = parse_competitive_pricing(response)
+
+    def parsed(asin, results=None, errors=None):
+        params = {'MarketplaceId': market_id, 'ASINList': [asin]}
+        return format_parsed_response('GetCompetitivePricingForASIN', params, results, errors)
+
+    return (
+        {asin: parsed(asin, results={asin: results[asin]}) for asin in asins if asin in results},
+        {
+            asin: parsed(asin, errors={asin: errors[asin]}) for asin in asins
+            if asin in errors and errors[asin].split(':')[0] in task.cacheable_errors
+        }
+    )
+
+
+def parse_competitive_pricing(response):
+    """Parse a GetCompetitivePricingForASIN response into dictionaries of results and errors, keyed by ASIN."""
     results, errors = {}, {}
     for result_tag in response.tree.iterdescendants('GetCompetitivePricingForASINResult'):
         price = {}
@@ -151,9 +250,7 @@ def GetCompetitivePricingForASIN(self, asin=None, **kwargs):
             if price_tag.attrib.get('condition') != 'New':
                 continue
 
-            price['listing_price'] = response.xpath_get('.//ListingPrice/Amount', price_tag, _type=float)
-            price['shipping'] = response.xpath_get('.//Shipping/Amount', price_tag, _type=float)
-            price['landed_price'] = response.xpath_get('.//LandedPrice/Amount', price_tag, _type=float)
+            price.update(competitive_price_fields(price_tag))
 
         for count_tag in result_tag.iterdescendants('OfferListingCount'):
             if count_tag.attrib.get('condition') == 'New':
@@ -164,6 +261,4 @@ def GetCompetitivePricingForASIN(self, asin=None, **kwargs):
 
         results[sku] = price
 
-    return format_parsed_response('GetCompetitivePricingForASIN', params, results, errors)
-
-
+    return results, errors
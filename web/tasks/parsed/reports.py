@@ -3,12 +3,32 @@ import csv
 from datetime import datetime
 
 from .common import *
+from app.models import AmzReportLineMixin
 import tasks.mws.reports as mws
 
 
 ########################################################################################################################
 
 
+def mws_datetime(value):
+    """Parse an MWS timestamp, dropping the UTC offset."""
+    return datetime.strptime(value.split('+')[0], '%Y-%m-%dT%H:%M:%S')
+
+
+# Fields extracted from each ReportRequestInfo in a GetReportRequestList response
+report_request_fields = FieldExtractor(
+    request_id=Field('.//ReportRequestId'),
+    type=Field('.//ReportType'),
+    status=Field('.//ReportProcessingStatus'),
+    report_id=Field('.//GeneratedReportId'),
+    start_date=Field('.//StartDate', _type=mws_datetime),
+    end_date=Field('.//EndDate', _type=mws_datetime)
+)
+
+
+########################################################################################################################
+
+
 @celery_app.task(bind=True)
 def RequestReport(self, report_type, start=None, end=None, **kwargs):
     """Request a report."""
@@ -62,46 +82,30 @@ def GetReportRequestList(self, request_ids=None, **kwargs):
         }.items() if v is not None
     }
 
-    response = AmzXmlResponse(
-        mws.GetReportRequestList(**params)
-    )
-
-    if response.error_code:
-        return format_parsed_response('GetReportRequestList', params, errors=response.error_as_json())
-
-    iso_8601 = '%Y-%m-%dT%H:%M:%S'
     results = []
-    while response is not None:
-        for tag in response.tree.iterdescendants('ReportRequestInfo'):
-            info = {
-                'request_id':   response.xpath_get('.//ReportRequestId', tag),
-                'type':         response.xpath_get('.//ReportType', tag),
-                'status':       response.xpath_get('.//ReportProcessingStatus', tag),
-                'report_id':    response.xpath_get('.//GeneratedReportId', tag),
-
-                'start_date':   datetime.strptime(
-                    response.xpath_get('.//StartDate', tag).split('+')[0],
-                    iso_8601
-                ),
-                'end_date':     datetime.strptime(
-                    response.xpath_get('.//EndDate', tag).split('+')[0],
-                    iso_8601
-                )
-            }
-
-            results.append(info)
-
-            has_next, next_token = response.xpath_get('.//HasNext'), response.xpath_get('.//NextToken')
-            if has_next == 'true':
-                response = AmzXmlResponse(
-                    mws.GetReportRequestListByNextToken(NextToken=next_token)
-                )
-            else:
-                response = None
+    try:
+        for page in iter_report_request_list(priority=self.get_priority(), **params):
+            results.extend(page)
+    except PageError as e:
+        return format_parsed_response('GetReportRequestList', params, results, errors=e.response.error_as_json())
 
     return format_parsed_response('GetReportRequestList', params, results)
 
 
+def iter_report_request_list(priority=0, **params):
+    """Yield pages of GetReportRequestList results as they arrive, prefetching each next page. See iter_pages()."""
+    return iter_pages(
+        lambda: mws.GetReportRequestList(**params, priority=priority),
+        lambda token: mws.GetReportRequestListByNextToken(NextToken=token, priority=priority),
+        parse_report_request_list
+    )
+
+
+def parse_report_request_list(response):
+    """Parse a page of GetReportRequestList results into a list of report requests."""
+    return [report_request_fields(tag) for tag in response.iter_elements('ReportRequestInfo')]
+
+
 @celery_app.task(bind=True)
 def GetReport(self, report_id, report_type, **kwargs):
     """Get and parse a report."""
@@ -115,34 +119,54 @@ def GetReport(self, report_id, report_type, **kwargs):
     }
 
     report = mws.GetReport(**params)
+    results = parse_report(report, report_type)
+
+    return format_parsed_response('GetReport', params, results)
+
+
+def parse_report(report, report_type):
+    """Parse the body of a report into a list of dictionaries, one per line."""
+    return list(parse_report_lines(io.StringIO(report), report_type))
+
+
+class ReportError(Exception):
+    """Raised by iter_report() when the download is an error response instead of a report."""
+
+    def __init__(self, status_code, error_code=None):
+        super().__init__(f'Report download failed with status {status_code}: {error_code or "no error code"}')
+        self.status_code = status_code
+        self.error_code = error_code
+
+
+def iter_report(report_id, report_type, priority=0):
+    """Download a report and yield its lines as dictionaries, as they arrive. The report is never held in memory (or
+    cached) as a whole, so this is the way to read big reports from ops tasks. Raises ReportError before yielding
+    anything if the download is an error response."""
+    response = mws.GetReport.stream_api_call(ReportId=report_id, priority=priority)
+
+    try:
+        # Reports are plain text, and errors are small XML bodies, so only read the body here if it could be an error
+        if not response.ok or 'xml' in response.headers.get('Content-Type', ''):
+            error_code = mws.GetReport.response_error_code(response.text)
+            if not response.ok or error_code:
+                raise ReportError(response.status_code, error_code)
+
+        response.encoding = response.encoding or 'utf-8'
+        yield from parse_report_lines(response.iter_lines(decode_unicode=True), report_type)
+    finally:
+        response.close()
+
+
+def parse_report_lines(lines, report_type):
+    """Parse an iterable of report lines (including the header), yielding a dictionary for each line. Values are
+    converted to the types of the matching columns on the report type's line class; values without a column are left
+    as strings."""
+    converters = AmzReportLineMixin.for_report_type(report_type).converters()
+
+    tsv = csv.reader(lines, delimiter='\t')
+    keys = [k.replace('-', '_') for k in next(tsv, [])]
+    converts = [converters.get(k, str) for k in keys]
 
-    def type_cast(key, value):
-        if 'price' in key:
-            return float(value) if value else None
-        elif 'quantity' in key:
-            return int(value) if value else None
-        elif 'exists' in key:
-            if value.lower() == 'yes':
-                return True
-            elif value.lower() == 'no':
-                return False
-            else:
-                return bool(value) if value else None
-        elif 'volume' in key:
-            return float(value) if value else None
-        else:
-            return value
-
-    if report_type == '_GET_FBA_MYI_UNSUPPRESSED_INVENTORY_DATA_':
-        buffer = io.StringIO(report)
-        tsv = csv.DictReader(buffer, delimiter='\t')
-        results = [
-            {
-                k.replace('-', '_'): type_cast(k, v)
-                for k, v in d.items()
-            } for d in tsv
-        ]
-    else:
-        raise ValueError(f'Unsupported report type: {report_type}')
-
-    return format_parsed_response('GetReport', params, results)
\ No newline at end of file
+    for row in tsv:
+        if row:
+            yield {k: convert(v) for k, convert, v in zip(keys, converts, row)}